@@ -0,0 +1,63 @@
+#  Copyright (c) 2020 Xavier Baró
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE TFR benchmark tests module """
+import pytest
+import simplejson
+
+
+def test_benchmark_stages(tfr_provider):
+    from tfr.benchmark import run_benchmark
+    stages = ['base64_decode', 'pil_decode', 'sample_decode', 'sample_decode_legacy', 'rgba_conversion', 'black_check',
+              'distance_10', 'distance_100', 'model_load', 'model_load_cached', 'model_load_legacy_format',
+              'coarse_detection', 'coarse_detection_legacy', 'cascade_detection', 'cascade_detection_legacy',
+              'quality_gate_720p', 'verify_batch', 'verify_batch_legacy', 'roi_tracking', 'roi_tracking_legacy']
+    results = run_benchmark(stages, iterations=3)
+    assert list(results['stages'].keys()) == stages
+    for stage in stages:
+        for key in ['throughput_per_s', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_bytes', 'peak_alloc_bytes']:
+            assert results['stages'][stage][key] > 0
+    assert results['peak_rss_bytes'] > 0
+
+
+def test_benchmark_cli(tfr_provider, tmpdir, monkeypatch):
+    from tfr.benchmark import main
+    # The entry point enables DEBUG when it is not set, as no TeSLA CE configuration is available
+    monkeypatch.setenv('DEBUG', '1')
+    output = tmpdir.join('results.json')
+    main(['--stages', 'detection_hog,encoding_jitter_1,audit_image,startup_import', '--iterations', '2',
+          '--output', str(output)])
+    results = simplejson.loads(output.read())
+    assert set(results['stages'].keys()) == {'detection_hog', 'encoding_jitter_1', 'audit_image', 'startup_import'}
+
+    with pytest.raises(ValueError):
+        main(['--stages', 'unknown'])
+
+
+def test_child_memory(tfr_provider):
+    from tfr.benchmark import measure_child_memory
+    results = measure_child_memory(num_children=2)
+    if results is None:
+        pytest.skip('Private memory cannot be measured in this platform')
+    # Children share the models loaded before forking
+    assert results['preloaded']['mean_private_bytes'] < results['lazy']['mean_private_bytes']
+
+
+def test_layouts(tfr_provider):
+    from tfr.benchmark import measure_layouts
+    results = measure_layouts([(1, 1), (2, 1)], iterations=2)
+    assert list(results.keys()) == ['1x1', '2x1']
+    for layout in results.values():
+        assert layout['throughput_per_s'] > 0
+    assert results['2x1']['images'] == 4
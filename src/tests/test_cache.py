@@ -0,0 +1,88 @@
+#  Copyright (c) 2020 Xavier Baró
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE TFR cache tests module """
+from .test_models import create_model, get_random_encodings
+
+
+def test_lru_eviction(tfr_provider):
+    from tfr.provider.cache import LRUCache
+    cache = LRUCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    # b is the least recently used entry
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+    stats = cache.stats()
+    assert stats['size'] == 2
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+    assert stats['evictions'] == 1
+
+    # Reduce the size
+    cache.configure(max_size=1)
+    assert len(cache) == 1
+    assert cache.get('c') == 3
+
+    # Disable the cache
+    cache.configure(max_size=0)
+    cache.put('d', 4)
+    assert len(cache) == 0
+    assert not cache.enabled
+
+
+def test_lru_expiration(tfr_provider, monkeypatch):
+    from tfr.provider import cache as cache_module
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, 'monotonic', lambda: now[0])
+
+    cache = cache_module.LRUCache(max_size=10, ttl=60)
+    cache.put('a', 1)
+    now[0] += 30
+    assert cache.get('a') == 1
+    now[0] += 31
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_model_cache(tfr_provider):
+    from tfr.provider.models import get_model_key
+    model = create_model(get_random_encodings(10)).to_json()
+    other_model = create_model(get_random_encodings(10, seed=1)).to_json()
+    assert get_model_key(model) == get_model_key(dict(model))
+    assert get_model_key(model) != get_model_key(other_model)
+    assert get_model_key(model) != get_model_key(dict(model, percentage=0.5))
+    assert get_model_key(model) != get_model_key(dict(model, data=dict(model['data'], dtype='float16')))
+
+    tfr_provider.set_options({'model_cache_size': 10})
+    tfr_model = tfr_provider._load_model('learner', model)
+    assert tfr_provider._load_model('learner', model) is tfr_model
+    assert tfr_provider._load_model('learner', other_model) is not tfr_model
+    assert tfr_provider._load_model('other_learner', model) is not tfr_model
+    stats = tfr_provider.get_cache_stats()['models']
+    assert stats['hits'] == 1
+    assert stats['misses'] == 3
+
+    # Legacy models are decoded on each request, as they are faster to decode than to identify
+    legacy_model = dict(model, data=None, samples=[{'id': sample['id'], 'features': encoding.tolist()} for
+                                                   sample, encoding in zip(model['samples'], get_random_encodings(10))])
+    assert get_model_key(legacy_model) is None
+    legacy_tfr_model = tfr_provider._load_model('learner', legacy_model)
+    assert legacy_tfr_model.get_encodings().shape == (10, 128)
+    assert tfr_provider._load_model('learner', legacy_model) is not legacy_tfr_model
+    assert tfr_provider.get_cache_stats()['models'] == stats
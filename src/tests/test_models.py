@@ -0,0 +1,214 @@
+#  Copyright (c) 2020 Xavier Baró
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE TFR models tests module """
+import numpy as np
+from .tfr_utils import get_sample
+
+
+def get_random_encodings(num_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(-0.3, 0.3, (num_samples, 128))
+
+
+def create_model(encodings, model_class=None):
+    from tfr.provider.models import FRSimpleModel
+    if model_class is None:
+        model_class = FRSimpleModel
+    model = model_class()
+    for idx, encoding in enumerate(encodings):
+        model.add_sample(get_sample(sample_id=idx), [encoding])
+    return model
+
+
+def test_encodings_matrix(tfr_provider):
+    encodings = get_random_encodings(20)
+    model = create_model(encodings)
+
+    matrix = model.get_encodings()
+    assert matrix.dtype == np.float32
+    assert matrix.shape == (20, 128)
+    assert matrix.flags['C_CONTIGUOUS']
+    # Matrix is cached between calls
+    assert model.get_encodings() is matrix
+
+    # Adding a sample invalidates the matrix
+    model.add_sample(get_sample(sample_id=20), [get_random_encodings(1, seed=1)[0]])
+    assert model.get_encodings() is not matrix
+    assert model.get_encodings().shape == (21, 128)
+
+
+def test_distances(tfr_provider):
+    encodings = get_random_encodings(30)
+    model = create_model(encodings)
+    face = get_random_encodings(1, seed=2)[0]
+
+    expected = np.linalg.norm(encodings - face, axis=1)
+    distances = model.get_distances(face)
+    assert distances.shape == (30, )
+    assert np.allclose(distances, expected, atol=1e-4)
+
+    # Distance of a sample with itself
+    assert model.get_distances(encodings[3])[3] < 1e-3
+
+
+def test_binary_serialization(tfr_provider):
+    from tfr.provider.models import FRSimpleModel, MODEL_FORMAT_VERSION
+    encodings = get_random_encodings(15)
+    model = create_model(encodings)
+
+    model_json = model.to_json()
+    assert model_json['data']['version'] == MODEL_FORMAT_VERSION
+    assert model_json['data']['dtype'] == 'float32'
+    assert model_json['data']['shape'] == [15, 128]
+    assert len(model_json['samples']) == 15
+    for sample in model_json['samples']:
+        assert sample['features'] is None
+
+    loaded = FRSimpleModel(model_json)
+    assert loaded.get_used_samples() == list(range(15))
+    assert np.array_equal(loaded.get_encodings(), model.get_encodings())
+
+    # Half precision storage
+    model.set_encodings_dtype('float16')
+    model_json_f16 = model.to_json()
+    assert model_json_f16['data']['dtype'] == 'float16'
+    assert len(model_json_f16['data']['encodings']) < len(model_json['data']['encodings'])
+    loaded = FRSimpleModel(model_json_f16)
+    assert np.allclose(loaded.get_encodings(), encodings, atol=1e-3)
+
+
+def test_legacy_model(tfr_provider):
+    from tfr.provider.models import FRSimpleModel
+    encodings = get_random_encodings(5)
+    legacy_json = {
+        'percentage': 0.5,
+        'samples': [{'id': idx, 'features': list(encoding)} for idx, encoding in enumerate(encodings)],
+        'data': None
+    }
+    model = FRSimpleModel(legacy_json)
+    assert np.allclose(model.get_encodings(), encodings, atol=1e-6)
+
+    # Add a new sample and store with the new format
+    model.add_sample(get_sample(sample_id=5), [get_random_encodings(1, seed=1)[0]])
+    model_json = model.to_json()
+    assert model_json['data']['shape'] == [6, 128]
+    assert FRSimpleModel(model_json).get_used_samples() == list(range(6))
+
+
+def test_prototype_model(tfr_provider):
+    from tfr.provider.models import FRPrototypeModel, FRSimpleModel, get_model_mode
+    encodings = get_random_encodings(40)
+    model = FRPrototypeModel()
+    model.set_max_prototypes(8)
+    model.set_required_samples(20)
+    model.set_min_required_samples(10)
+    for idx, encoding in enumerate(encodings):
+        model.add_sample(get_sample(sample_id=idx), [encoding])
+        assert model.can_analyse() == (idx + 1 >= 10)
+
+    # Number of references is bounded, but all the samples count for the enrolment
+    assert model.get_encodings().shape == (8, 128)
+    assert model.get_num_samples() == 40
+    assert abs(model.get_percentage() - 1.0) < 1e-6
+    assert np.allclose(model.get_mean(), encodings.mean(axis=0), atol=1e-5)
+
+    # Prototypes keep the id of their sample
+    used_samples = model.get_used_samples()
+    assert len(used_samples) == 8
+    for idx, sample_id in enumerate(used_samples):
+        assert np.allclose(model.get_encodings()[idx], encodings[sample_id], atol=1e-6)
+
+    # Serialized model can be used as a simple model for verification
+    model_json = model.to_json()
+    assert get_model_mode(model_json) == 'prototypes'
+    loaded = FRPrototypeModel(model_json)
+    assert loaded.get_num_samples() == 40
+    assert np.allclose(loaded.get_mean(), model.get_mean(), atol=1e-6)
+    simple = FRSimpleModel(model_json)
+    assert simple.get_used_samples() == used_samples
+    assert simple.get_distances(encodings[used_samples[3]])[3] < 1e-3
+
+
+def test_prototype_model_from_simple_model(tfr_provider):
+    from tfr.provider.models import FRPrototypeModel, get_model_mode
+    encodings = get_random_encodings(12)
+    model_json = create_model(encodings).to_json()
+    assert get_model_mode(model_json) == 'samples'
+
+    model = FRPrototypeModel(model_json)
+    model.set_max_prototypes(5)
+    assert model.get_num_samples() == 12
+    model.add_sample(get_sample(sample_id=12), [get_random_encodings(1, seed=1)[0]])
+    assert model.get_encodings().shape == (5, 128)
+    assert model.get_num_samples() == 13
+
+
+def test_duplicate_samples(tfr_provider):
+    from tfr.provider.models import FRSimpleModel
+    encodings = get_random_encodings(5)
+    duplicate = encodings[2] + 0.001
+
+    for policy, expected_samples in [('keep', [0, 1, 2, 3, 4, 5]), ('skip', [0, 1, 2, 3, 4]),
+                                     ('replace', [0, 1, 5, 3, 4])]:
+        model = create_model(encodings)
+        model.set_required_samples(6)
+        model.set_duplicate_policy(policy, 0.1)
+        model.add_sample(get_sample(sample_id=5), [duplicate])
+        # Duplicates always count for the enrolment
+        assert model.get_num_samples() == 6
+        assert abs(model.get_percentage() - 1.0) < 1e-6
+        assert model.get_used_samples() == expected_samples
+        assert model.get_encodings().shape == (len(expected_samples), 128)
+        if 5 in expected_samples:
+            assert np.allclose(model.get_encodings()[expected_samples.index(5)], duplicate, atol=1e-6)
+
+        loaded = FRSimpleModel(model.to_json())
+        assert loaded.get_num_samples() == 6
+        assert loaded.get_used_samples() == expected_samples
+
+    # Different samples are always stored
+    model = create_model(encodings)
+    model.set_duplicate_policy('skip', 0.1)
+    model.add_sample(get_sample(sample_id=5), [get_random_encodings(1, seed=1)[0]])
+    assert model.get_used_samples() == [0, 1, 2, 3, 4, 5]
+
+
+def test_search(tfr_provider):
+    from tfr.provider.models import SEARCH_BLOCK_SIZE
+    encodings = get_random_encodings(300)
+    model = create_model(encodings)
+    faces = np.concatenate([get_random_encodings(3, seed=3), encodings[[250, 10]] + 0.001])
+
+    # Same result as the full distance vector of each face
+    indexes, distances = model.search(faces)
+    for face, idx, distance in zip(faces, indexes, distances):
+        expected = model.get_distances(face)
+        assert idx == int(np.argmin(expected))
+        assert abs(distance - expected[idx]) < 1e-4
+    assert list(indexes[3:]) == [250, 10]
+
+    # Search stops when all the faces have an accepted match
+    indexes, distances = model.search(faces[3:], accept_distance=0.1)
+    assert list(indexes) == [250, 10]
+
+    # With early exit, the reference is the closest one of the searched blocks, not the closest one of the model
+    expected = model.get_distances(faces[3])
+    indexes, distances = model.search(faces[3:4], accept_distance=10.0)
+    assert SEARCH_BLOCK_SIZE < 300
+    assert indexes[0] == int(np.argmin(expected[:SEARCH_BLOCK_SIZE])) != 250
+    assert abs(distances[0] - expected[indexes[0]]) < 1e-4
+    assert distances[0] > expected[250]
+    indexes, distances = model.search(faces[3:4], accept_distance=10.0, block_size=300)
+    assert indexes[0] == 250
@@ -44,9 +44,304 @@ def test_get_sample_image(tfr_provider):
     assert image is not None
 
 
+def test_get_sample_image_memory(tfr_provider):
+    import pytest
+    from types import SimpleNamespace
+    from tfr.benchmark import legacy_get_sample_image, measure_memory
+    from tfr.provider.utils import get_sample_image
+
+    for img in ['valid_image', 'no_face', 'multiple_faces']:
+        sample = get_sample(image=img)
+        image = get_sample_image(sample)
+        legacy_image = legacy_get_sample_image(sample)
+        assert image.shape == legacy_image.shape
+        assert (image == legacy_image).all()
+
+        # Pixels of large images are not held twice in memory
+        if img != 'valid_image':
+            new_peak = measure_memory(lambda idx: get_sample_image(sample))
+            legacy_peak = measure_memory(lambda idx: legacy_get_sample_image(sample))
+            assert new_peak < 0.75 * legacy_peak
+
+    # Non ASCII data is rejected as in previous versions
+    non_ascii = SimpleNamespace(data='data:image/jpeg;base64,\u00e9' + sample.data.split(',')[1])
+    with pytest.raises(ValueError):
+        legacy_get_sample_image(non_ascii)
+    with pytest.raises(ValueError):
+        get_sample_image(non_ascii)
+
+
 def test_get_sample_video(tfr_provider):
     from tfr.provider.utils import get_sample_image
     from tesla_ce_provider.models.base import Sample
 
 
+def test_get_data_hash(tfr_provider):
+    from tfr.provider.utils import get_data_hash
+    sample = get_sample()
+    assert get_data_hash(sample.data) == get_data_hash((sample.data + ' ')[:-1])
+    assert get_data_hash(sample.data) != get_data_hash(get_sample(image='no_face').data)
+
+
+def test_resize_image(tfr_provider):
+    import numpy as np
+    from tfr.provider.utils import resize_image, scale_face_location
+    image = np.zeros((720, 1280, 3), dtype=np.uint8)
+    resized, scale = resize_image(image, 320)
+    assert resized.shape == (180, 320, 3)
+    assert abs(scale - 4.0) < 1e-6
+    assert scale_face_location((10, 50, 40, 20), scale, image.shape) == (40, 200, 160, 80)
+    assert scale_face_location((-1, 330, 200, 20), scale, image.shape) == (0, 1280, 720, 80)
+
+    # Small images are not changed
+    resized, scale = resize_image(image, 2000)
+    assert resized is image
+    assert scale == 1.0
+
+
+def test_decode_sample_image_max_side(tfr_provider):
+    from io import BytesIO
+    from PIL import Image
+    from tfr.provider.utils import decode_sample_image, get_sample_image
+
+    sample = get_sample(image='user2_enr_left1')
+    image = get_sample_image(sample)
+    reduced, scale = decode_sample_image(sample, 300)
+    assert max(reduced.shape[:2]) == 300
+    assert abs(reduced.shape[1] * scale - image.shape[1]) < 1e-6
+
+    # Images smaller than the maximum size are not changed
+    same, same_scale = decode_sample_image(sample, 2000)
+    assert same.shape == image.shape
+    assert same_scale == 1.0
+
+    # PNG images are resized after decoding
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer, format='png')
+    png_sample = get_sample(image_data=base64.b64encode(buffer.getvalue()).decode(), data_mimetype='image/png')
+    png_reduced, png_scale = decode_sample_image(png_sample, 300)
+    assert png_reduced.shape == reduced.shape
+    assert abs(png_scale - scale) < 1e-6
+
+
+def test_remove_alpha(tfr_provider):
+    import numpy as np
+    from tfr.benchmark import legacy_remove_alpha
+    from tfr.provider.utils import remove_alpha
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 256, (120, 160, 4)).astype(np.uint8)
+    image[..., 3] = 255
+    assert (remove_alpha(image) == image[..., :3]).all()
+
+    image[:20, :, 3] = 0
+    rgb = remove_alpha(image)
+    assert rgb.flags.c_contiguous
+    assert (rgb == legacy_remove_alpha(image.copy())).all()
+    assert (rgb[:20] == 0).all()
+
+
+def test_is_black_image(tfr_provider):
+    import numpy as np
+    from tfr.benchmark import legacy_is_black_image
+    from tfr.provider.utils import is_black_image
+    rng = np.random.RandomState(0)
+    for max_value in [1, 5, 6, 12, 256]:
+        for shape in [(1, 1, 3), (7, 300, 3), (480, 640, 3)]:
+            image = rng.randint(0, max_value, shape).astype(np.uint8)
+            assert is_black_image(image) == legacy_is_black_image(image)
+
+    # A single bright pixel missed by the subsample
+    image = np.zeros((480, 640, 3), dtype=np.uint8)
+    image[1, 1] = 255
+    assert not is_black_image(image)
+    image[1, 1] = 0
+    assert is_black_image(image)
+
+    # Bright frames are not black
+    assert not is_black_image(np.full((480, 640, 3), 255, dtype=np.uint8))
+
+
+def test_get_luma(tfr_provider):
+    import numpy as np
+    from PIL import Image
+    from tfr.provider.utils import get_luma
+    white = get_luma(np.full((4, 6, 3), 255, dtype=np.uint8))
+    assert white.shape == (4, 6)
+    assert (white == 255).all()
+
+    grey = np.empty((4, 6, 3), dtype=np.uint8)
+    grey[...] = [200, 100, 50]
+    assert (get_luma(grey) == 124).all()
+    assert (get_luma(np.full((4, 6, 3), 200, dtype=np.uint8)) == 200).all()
+
+    # Same values than PIL grayscale conversion
+    image = np.random.RandomState(0).randint(0, 256, (120, 160, 3)).astype(np.uint8)
+    assert (get_luma(image) == np.asarray(Image.fromarray(image).convert('L'))).all()
+
+
+def test_check_image_quality(tfr_provider):
+    import numpy as np
+    from PIL import Image, ImageFilter
+    from tfr.provider.utils import get_sample_image, check_image_quality
+    image = get_sample_image(get_sample(image='user2_enr_left1'))
+    thresholds = {'min_sharpness': 50, 'min_contrast': 20, 'min_brightness': 20, 'max_brightness': 235}
+    assert check_image_quality(image, **thresholds)['valid']
+
+    blurred = np.asarray(Image.fromarray(image).filter(ImageFilter.GaussianBlur(8)))
+    quality_check = check_image_quality(blurred, **thresholds)
+    assert not quality_check['valid']
+    assert quality_check['msg'] == 'Blurred image.'
+    assert quality_check['quality']['sharpness'] < 50
+
+    assert check_image_quality(np.full_like(image, 128), **thresholds)['msg'] == 'Low contrast image.'
+    assert check_image_quality(np.full_like(image, 250), **thresholds)['msg'] == 'Overexposed image.'
+    assert check_image_quality(image // 16, **thresholds)['msg'] == 'Underexposed image.'
+
+
+def test_get_image_quality(tfr_provider):
+    import numpy as np
+    from PIL import Image
+    from tfr.provider.utils import get_image_quality, get_sample_image
+    grey = np.empty((480, 640, 3), dtype=np.uint8)
+    grey[...] = [200, 100, 50]
+    quality = get_image_quality(grey)
+    assert quality == {'sharpness': 0.0, 'contrast': 0.0, 'brightness': 124.0}
+
+    # Half black and half white image
+    image = np.zeros((480, 640, 3), dtype=np.uint8)
+    image[:, 320:] = 255
+    quality = get_image_quality(image)
+    assert abs(quality['brightness'] - 127.5) < 1e-6
+    assert quality['contrast'] == 255.0
+    assert quality['sharpness'] > 0
+
+    # Brightness of a real sample is the mean of the PIL grayscale conversion
+    image = get_sample_image(get_sample(image='user2_enr_left1'))
+    step = int(np.ceil(max(image.shape[:2]) / 256.0))
+    expected = np.asarray(Image.fromarray(image).convert('L'))[::step, ::step].mean()
+    assert abs(get_image_quality(image)['brightness'] - expected) < 1e-3
+
+
+def test_get_face_image(tfr_provider):
+    import numpy as np
+    from io import BytesIO
+    from PIL import Image
+    from tfr.benchmark import legacy_get_face_image
+    from tfr.provider.utils import get_face_image
+
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 256, (480, 640, 3)).astype(np.uint8)
+    location = (100, 300, 250, 150)
+
+    def decode(face_image):
+        return Image.open(BytesIO(base64.b64decode(face_image.split(',')[1])))
+
+    # Same crop as previous implementation
+    face_image = get_face_image(image, location)
+    assert face_image.startswith('data:image/jpeg;base64,')
+    assert face_image == legacy_get_face_image(image, location)
+    assert decode(face_image).size == (150, 150)
+
+    # Thumbnail size cap and JPEG quality
+    assert decode(get_face_image(image, location, max_side=64)).size == (64, 64)
+    assert len(get_face_image(image, location, quality=30)) < len(face_image)
+
+
+def test_stage_timer(tfr_provider):
+    from tfr.provider.timing import StageTimer, NULL_TIMER
+    timer = StageTimer('operation')
+    with timer.stage('stage_1'):
+        pass
+    with timer.stage('stage_1'):
+        pass
+    timer.add('stage_2', 0.5)
+    timings = timer.get_timings()
+    assert list(timings.keys()) == ['stage_1', 'stage_2', 'total']
+    assert timings['stage_2'] == 500.0
+
+    with NULL_TIMER.stage('stage_1'):
+        pass
+    assert NULL_TIMER.get_timings() == {}
+
+
+def test_lazy_import():
+    import os
+    import subprocess
+    import sys
+    src_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = 'import sys, tfr.provider; assert "dlib" not in sys.modules; ' \
+           'tfr.provider.tfr.face_recognition.face_locations; assert "dlib" in sys.modules'
+    # The new interpreter has no TeSLA CE configuration
+    env = dict(os.environ, DEBUG='1')
+    subprocess.run([sys.executable, '-c', code], cwd=src_path, env=env, check=True)
+
+
+def test_lazy_import_threads():
+    import os
+    import subprocess
+    import sys
+    src_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # Parallel enrolment on a new process, where face_recognition has not been loaded yet
+    code = """
+import sys
+from tfr.provider.tfr import TFRProvider
+from tests.tfr_utils import get_sample
+assert 'dlib' not in sys.modules
+provider = TFRProvider()
+provider.set_logger(None)
+provider.set_options({'enrol_workers': 4, 'model': 'hog', 'min_enrol_samples': 3, 'target_enrol_samples': 6})
+images = ['user1_enr_front1', 'user1_enr_left1', 'user1_enr_right1', 'user1_enr_down1']
+result = provider.enrol([get_sample(image=img, sample_id=idx) for idx, img in enumerate(images)], model=None)
+assert result.valid, result.error_message
+assert result.used_samples == [0, 1, 2, 3]
+"""
+    env = dict(os.environ, DEBUG='1')
+    subprocess.run([sys.executable, '-c', code], cwd=src_path, env=env, check=True)
+
+
+def test_thread_safe_models(tfr_provider):
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    import face_recognition
+    from tfr.provider.utils import get_sample_image, set_thread_safe_models, ModelPool
+    images = [get_sample_image(get_sample(image=img))
+              for img in ['user1_enr_front1', 'user1_enr_left1', 'user1_enr_right1', 'user1_enr_down1']]
+
+    def encode(image):
+        return face_recognition.face_encodings(image, face_recognition.face_locations(image), num_jitters=1)
+
+    expected = [encode(image) for image in images]
+    set_thread_safe_models(face_recognition)
+    assert isinstance(face_recognition.api.face_encoder, ModelPool)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        encodings = list(pool.map(encode, images * 3))
+    for image_encodings, expected_encodings in zip(encodings, expected * 3):
+        assert len(image_encodings) == len(expected_encodings) == 1
+        assert np.allclose(image_encodings[0], expected_encodings[0])
+    # Instances are kept for later calls
+    assert 1 <= face_recognition.api.face_encoder.size <= 4
+
+
+def test_compute_threads(tfr_provider, monkeypatch):
+    import os
+    from tfr import TFRProvider
+    from tfr.provider.utils import THREAD_ENV_VARS
+    for name in THREAD_ENV_VARS:
+        monkeypatch.delenv(name, raising=False)
+
+    tfr_provider.set_options({'compute_threads': 1})
+    assert tfr_provider.compute_threads is not None
+    for name in THREAD_ENV_VARS:
+        assert os.environ[name] == '1'
+    for num_threads in tfr_provider.compute_threads.values():
+        assert int(num_threads) == 1
+
+    # Limit can be provided in an environment variable
+    monkeypatch.setenv('TFR_COMPUTE_THREADS', '2')
+    provider = TFRProvider()
+    assert provider.config['compute_threads'] == 2
 
+    # Limits applied before setting the logger are reported
+    messages = []
+    provider.set_logger(messages.append)
+    assert any(msg.startswith('TFR: Compute threads limited to 2') for msg in messages)
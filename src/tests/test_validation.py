@@ -144,3 +144,228 @@ def test_multiple_faces_image(tfr_provider):
     assert result.message_code_id == 'PROVIDER_MULTIPLE_PEOPLE'
     assert result.error_message == 'Multiple faces in the image.'
     assert result.status == 2
+
+
+def get_overlap(location_1, location_2):
+    top = max(location_1[0], location_2[0])
+    right = min(location_1[1], location_2[1])
+    bottom = min(location_1[2], location_2[2])
+    left = max(location_1[3], location_2[3])
+    intersection = max(0, bottom - top) * max(0, right - left)
+    area_1 = (location_1[2] - location_1[0]) * (location_1[1] - location_1[3])
+    area_2 = (location_2[2] - location_2[0]) * (location_2[1] - location_2[3])
+    return float(intersection) / float(area_1 + area_2 - intersection)
+
+
+def test_coarse_detection(tfr_provider, mocker):
+    import face_recognition
+    from tfr.provider.utils import get_sample_image, scale_face_location
+    image = get_sample_image(get_sample(image='user2_enr_left1'))
+
+    tfr_provider.set_options({'model': 'hog', 'detection_max_side': 0})
+    full_locations = tfr_provider._find_faces(image)
+
+    # Faces are detected in the reduced image, and the locations are mapped to the original image
+    locations_spy = mocker.spy(face_recognition, 'face_locations')
+    tfr_provider.set_options({'detection_max_side': 320, 'detection_refine': False})
+    coarse_locations = tfr_provider._find_faces(image)
+    assert locations_spy.call_count == 1
+    detection_image = locations_spy.call_args[0][0]
+    assert max(detection_image.shape[:2]) == 320
+    scale = float(image.shape[1]) / float(detection_image.shape[1])
+    assert coarse_locations == [scale_face_location(location, scale, image.shape)
+                                for location in locations_spy.spy_return]
+
+    # Refinement runs the detector on the full resolution region around the face
+    locations_spy.reset_mock()
+    tfr_provider.set_options({'detection_refine': True})
+    refined_locations = tfr_provider._find_faces(image)
+    assert locations_spy.call_count == 2
+    region = locations_spy.call_args_list[1][0][0]
+    assert region.shape[0] < image.shape[0] or region.shape[1] < image.shape[1]
+
+    assert len(full_locations) == len(coarse_locations) == len(refined_locations) == 1
+    assert get_overlap(full_locations[0], coarse_locations[0]) > 0.6
+    assert get_overlap(full_locations[0], refined_locations[0]) > 0.8
+
+
+def test_max_working_resolution(tfr_provider):
+    sample = get_sample(image='user2_enr_left1')
+    tfr_provider.set_options({'model': 'hog', 'fast_validation': False, 'max_working_resolution': 0})
+    full_result = tfr_provider.validate_sample(sample, validation_id=1)
+
+    tfr_provider.set_options({'max_working_resolution': 450})
+    reduced_result = tfr_provider.validate_sample(sample, validation_id=1)
+
+    check_validation_result(full_result)
+    check_validation_result(reduced_result)
+    assert full_result.status == reduced_result.status == 1
+
+    # Reported locations refer to the original image
+    locations = []
+    for validation_result in [full_result, reduced_result]:
+        face_location = validation_result.info['face_location']
+        locations.append((face_location['top'], face_location['left'] + face_location['width'] - 1,
+                          face_location['top'] + face_location['height'] - 1, face_location['left']))
+    assert get_overlap(locations[0], locations[1]) > 0.6
+
+
+def test_quality_gate(tfr_provider):
+    from io import BytesIO
+    from PIL import Image, ImageFilter
+    from tfr.provider.utils import get_sample_image
+    image = Image.fromarray(get_sample_image(get_sample(image='user2_enr_left1')))
+    buffer = BytesIO()
+    image.filter(ImageFilter.GaussianBlur(3)).save(buffer, format='jpeg')
+    sample = get_sample(image_data=base64.b64encode(buffer.getvalue()).decode(), data_mimetype='image/jpeg')
+
+    tfr_provider.set_options({'model': 'hog', 'fast_validation': False, 'quality_gate': 'reject',
+                              'quality_min_sharpness': 150})
+    result = tfr_provider.validate_sample(sample, validation_id=1)
+    check_validation_result(result)
+    assert result.status == 2
+    assert result.message_code_id == 'PROVIDER_LOW_QUALITY_IMAGE'
+    assert result.error_message == 'Blurred image.'
+
+    # Sharp images pass the gate
+    result = tfr_provider.validate_sample(get_sample(image='user2_enr_left1'), validation_id=1)
+    assert result.status == 1
+    assert result.info['info'] is None
+
+    # Low quality images are processed when the gate only warns
+    tfr_provider.set_options({'quality_gate': 'warn'})
+    result = tfr_provider.validate_sample(sample, validation_id=1)
+    assert result.status == 1
+    assert result.info['info']['warnings'] == ['PROVIDER_LOW_QUALITY_IMAGE']
+
+
+def test_cascade_detection(tfr_provider, mocker):
+    import face_recognition
+    from tfr.provider.utils import get_sample_image
+    spy = mocker.spy(face_recognition, 'face_locations')
+    batch_spy = mocker.spy(face_recognition, 'batch_face_locations')
+    tfr_provider.set_options({'model': 'cascade', 'fast_validation': False, 'upsample_times': 0})
+
+    # Faces found with hog are not searched again with cnn
+    result = tfr_provider.validate_sample(get_sample(image='valid_image'), validation_id=1)
+    assert result.status == 1
+    assert [call.kwargs['model'] for call in spy.call_args_list] == ['hog']
+
+    # Ambiguous results are checked with cnn
+    spy.reset_mock()
+    image = get_sample_image(get_sample(image='multiple_faces'))
+    face_locations = tfr_provider._find_faces(image)
+    assert len(face_locations) > 1
+    assert [call.kwargs['model'] for call in spy.call_args_list] == ['hog', 'cnn']
+
+    spy.reset_mock()
+    valid_image = get_sample_image(get_sample(image='valid_image'))
+    assert tfr_provider._find_faces_batch([valid_image, image]) == [
+        tfr_provider._find_faces(valid_image), face_locations]
+    assert batch_spy.call_count == 1
+    assert len(batch_spy.call_args[0][0]) == 1
+
+
+def test_cascade_multiple_faces(tfr_provider, mocker):
+    import numpy as np
+    import face_recognition
+    from PIL import Image
+    from tfr.provider.utils import get_sample_image
+    spy = mocker.spy(face_recognition, 'face_locations')
+    tfr_provider.set_options({'model': 'cascade', 'fast_validation': False, 'upsample_times': 0})
+
+    # Multiple faces samples are reported with the cascade detector
+    for image in ['multiple_faces', 'multiple_faces_2']:
+        result = tfr_provider.validate_sample(get_sample(image=image), validation_id=1)
+        assert result.message_code_id == 'PROVIDER_MULTIPLE_PEOPLE'
+
+    # With a tilted head, hog finds only one of the faces
+    image = get_sample_image(get_sample(image='multiple_faces_2'))
+    image = np.array(Image.fromarray(image).rotate(30))
+    assert len(face_recognition.face_locations(image, number_of_times_to_upsample=0, model='hog')) == 1
+
+    # Single small faces are checked with cnn
+    spy.reset_mock()
+    assert len(tfr_provider._find_faces(image)) == 2
+    assert len(tfr_provider._find_faces_batch([image])[0]) == 2
+    assert [call.kwargs['model'] for call in spy.call_args_list] == ['hog', 'cnn', 'hog']
+
+    # Without the size check, the second face is missed
+    tfr_provider.set_options({'cascade_min_face_size': 0})
+    assert len(tfr_provider._find_faces(image)) == 1
+
+    # The size check does not help when the face found by hog is large: the second face is also missed
+    image = np.ascontiguousarray(image[:, 100:])
+    tfr_provider.set_options({'cascade_min_face_size': 0.3})
+    assert len(face_recognition.face_locations(image, number_of_times_to_upsample=0, model='cnn')) == 2
+    assert len(tfr_provider._find_faces(image)) == 1
+    tfr_provider.set_options({'cascade_min_face_size': 0.4})
+    assert len(tfr_provider._find_faces(image)) == 2
+
+
+def test_detection_option_keys(tfr_provider):
+    from .tfr_utils import get_request
+    request = get_request(image='valid_image')
+    tfr_provider.set_options({'frame_cache_size': 10})
+    options = {'model': 'cascade', 'upsample_times': 2, 'cascade_min_face_size': 0.5, 'detection_max_side': 320,
+               'detection_refine': True, 'max_working_resolution': 640, 'roi_tracking': True, 'roi_margin': 0.5,
+               'roi_full_frame_interval': 5}
+    for name, value in options.items():
+        encoding_key = tfr_provider._get_encoding_key()
+        frame_key = tfr_provider._get_frame_key(request)
+        tfr_provider.set_options({name: value})
+        assert tfr_provider._get_encoding_key() != encoding_key, name
+        assert tfr_provider._get_frame_key(request) != frame_key, name
+    tfr_provider.set_options({'model': 'cnn', 'upsample_times': 1, 'cascade_min_face_size': 0.3,
+                              'detection_max_side': 0, 'detection_refine': False, 'max_working_resolution': 0,
+                              'roi_tracking': False, 'roi_margin': 0.75, 'roi_full_frame_interval': 10,
+                              'frame_cache_size': 0})
+
+
+def test_warm_up(tfr_provider, mocker):
+    import face_recognition
+    spy = mocker.spy(face_recognition, 'face_encodings')
+    tfr_provider.set_options({'model': 'hog'})
+    assert tfr_provider.warm_up(force=True) > 0
+    assert spy.call_count == 1
+
+    # Warm-up is done once per process
+    assert tfr_provider.warm_up() is None
+    assert spy.call_count == 1
+
+
+def test_warm_up_worker_process(tfr_provider, mocker, monkeypatch):
+    import face_recognition
+    from tfr import worker
+    from tfr.provider import tfr
+    spy = mocker.spy(face_recognition, 'face_locations')
+    monkeypatch.setattr(tfr, '_warm_up_pid', None)
+
+    # Without the task options, the worker is not warmed up with the default model
+    mocker.patch.object(worker, 'get_provider_options', return_value=None)
+    worker.warm_up_worker_process()
+    assert spy.call_count == 0
+
+    # The worker is warmed up with the model used by the tasks
+    mocker.patch.object(worker, 'get_provider_options', return_value={'model': 'hog', 'upsample_times': 0})
+    worker.warm_up_worker_process()
+    assert [(call.kwargs['model'], call.kwargs['number_of_times_to_upsample']) for call in spy.call_args_list] == [
+        ('hog', 0)]
+
+
+def test_set_options(tfr_provider):
+    # All the options in the provider description are handled
+    assert set(tfr_provider.info['options_schema']['properties'].keys()) == set(tfr_provider.OPTIONS.keys())
+
+    tfr_provider.set_options({'upsample_times': 2.0, 'detection_refine': True, 'roi_margin': 1, 'unknown': 1})
+    assert tfr_provider.config['number_of_times_to_upsample'] == 2
+    assert isinstance(tfr_provider.config['number_of_times_to_upsample'], int)
+    assert tfr_provider.config['detection_refine'] is True
+    assert isinstance(tfr_provider.config['roi_margin'], float)
+    assert 'unknown' not in tfr_provider.config
+
+    # Options do not change the rest of the configuration
+    config = dict(tfr_provider.config)
+    tfr_provider.set_options(None)
+    tfr_provider.set_options({})
+    assert tfr_provider.config == config
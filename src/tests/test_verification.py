@@ -115,6 +115,48 @@ def test_batch_enrolment(tfr_provider):
         assert (1.0 - result.model['percentage']) < 0.0001
 
 
+def test_parallel_batch_enrolment(tfr_provider, mocker):
+    import threading
+    from tesla_ce_provider.message import Provider
+    from tfr.provider.models import FRSimpleModel
+
+    user = users[0]
+    samples = []
+    for sample_id, img in enumerate(user['enrolment'][:4]):
+        samples.append(get_sample(image=img, sample_id=sample_id, learner_id=user['learner_id']))
+
+    tfr_provider.set_options({'min_enrol_samples': 3, 'target_enrol_samples': 6, 'enrol_workers': 1})
+    sequential_result = tfr_provider.enrol(samples=samples, model=None)
+    tfr_provider.set_options({'enrol_workers': 2})
+    process_sample = tfr_provider._process_enrolment_sample
+    threads = set()
+
+    def process_sample_in_thread(*args):
+        threads.add(threading.get_ident())
+        return process_sample(*args)
+
+    mocker.patch.object(tfr_provider, '_process_enrolment_sample', side_effect=process_sample_in_thread)
+    parallel_result = tfr_provider.enrol(samples=samples, model=None)
+    check_enrolment_result(parallel_result)
+    assert parallel_result.valid
+    # Samples are processed in threads of the worker process
+    assert len(threads) > 0
+    assert threading.get_ident() not in threads
+    assert parallel_result.used_samples == sequential_result.used_samples == [0, 1, 2, 3]
+    assert abs(parallel_result.percentage - sequential_result.percentage) < 0.0001
+    assert (abs(FRSimpleModel(parallel_result.model).get_encodings() -
+                FRSimpleModel(sequential_result.model).get_encodings()) < 0.05).all()
+
+    # First invalid sample stops the enrolment
+    samples.insert(2, get_sample(image='multiple_faces', sample_id=10, learner_id=user['learner_id']))
+    parallel_result = tfr_provider.enrol(samples=samples, model=None)
+    check_enrolment_result(parallel_result)
+    assert not parallel_result.valid
+    assert parallel_result.error_message == Provider.PROVIDER_MULTIPLE_PEOPLE.value
+    assert len(parallel_result.model['samples']) == 2
+    tfr_provider.set_options({'enrol_workers': 1})
+
+
 @pytest.mark.dependency(depends=["test_progressive_enrolment"], scope='module')
 def test_identity_verification_enrol(tfr_provider):
     test_progressive_enrolment(tfr_provider)
@@ -290,3 +332,326 @@ def test_batch_enrolment_with_normal_validation_other(tfr_provider):
         assert result.error_message is None
         assert result.can_analyse
         assert result.percentage > 0
+
+
+@pytest.mark.dependency(depends=["test_progressive_enrolment"], scope='module')
+def test_verify_repeated_frame(tfr_provider, mocker):
+    from tfr.provider import utils
+    user = users[0]
+    if user['learner_id'] not in models:
+        pytest.skip(PYTEST_MISSING_MODELS_MSG)
+
+    decode_spy = mocker.spy(utils, 'decode_sample_image')
+    tfr_provider.set_options({'frame_cache_size': 10, 'audit_images': 'never'})
+    request = get_request(image=user['test'][0], learner_id=user['learner_id'])
+    result = tfr_provider.verify(request, models[user['learner_id']])
+    check_verification_result(result)
+    assert decode_spy.call_count == 1
+
+    # Repeated frames are identified by their data, without decoding them
+    cached_result = tfr_provider.verify(get_request(image=user['test'][0], learner_id=user['learner_id'],
+                                                    request_id=2), models[user['learner_id']])
+    check_verification_result(cached_result)
+    assert decode_spy.call_count == 1
+    assert cached_result.code == result.code
+    assert abs(cached_result.result - result.result) < 1e-6
+    assert cached_result.audit['faces'][0]['coordinates'] == result.audit['faces'][0]['coordinates']
+
+    # The image is only decoded if it is needed for the audit
+    tfr_provider.set_options({'audit_images': 'always'})
+    cached_result = tfr_provider.verify(request, models[user['learner_id']])
+    assert decode_spy.call_count == 2
+    assert cached_result.audit['faces'][0]['image'] is not None
+
+    stats = tfr_provider.get_cache_stats()['frames']
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+
+    # Faces detected with other detection options are not reused
+    tfr_provider.set_options({'cascade_min_face_size': 0.5})
+    tfr_provider.verify(request, models[user['learner_id']])
+    stats = tfr_provider.get_cache_stats()['frames']
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+    tfr_provider.set_options({'cascade_min_face_size': 0.3})
+
+
+@pytest.mark.dependency(depends=["test_progressive_enrolment"], scope='module')
+def test_verify_batch(tfr_provider):
+    user = users[0]
+    if user['learner_id'] not in models:
+        pytest.skip(PYTEST_MISSING_MODELS_MSG)
+
+    # Limit the size of the full HD frames, which share a batch of the cnn detector
+    tfr_provider.set_options({'max_working_resolution': 640})
+    images = user['test'] + ['no_face', 'black_image', 'multiple_faces'] + user['enrolment'][:2]
+    requests = [get_request(image=img, learner_id=user['learner_id'], request_id=idx)
+                for idx, img in enumerate(images)]
+    results = tfr_provider.verify_batch(requests, [models[user['learner_id']]] * len(requests))
+    assert len(results) == len(requests)
+    for request, result in zip(requests, results):
+        check_verification_result(result)
+        expected = tfr_provider.verify(request, models[user['learner_id']])
+        assert result.status == expected.status
+        assert result.code == expected.code
+        assert result.message_code == expected.message_code
+        if expected.result is not None:
+            assert abs(result.result - expected.result) < 0.05
+    tfr_provider.set_options({'max_working_resolution': 0})
+
+
+@pytest.mark.dependency(depends=["test_progressive_enrolment"], scope='module')
+def test_verify_session_tracking(tfr_provider):
+    user = users[0]
+    if user['learner_id'] not in models:
+        pytest.skip(PYTEST_MISSING_MODELS_MSG)
+
+    tfr_provider.set_options({'roi_tracking': True, 'roi_full_frame_interval': 2})
+    session_key = (user['learner_id'], 3)
+    request = get_request(image=user['test'][0], learner_id=user['learner_id'], session_id=3)
+    full_result = tfr_provider.verify(request, models[user['learner_id']])
+    assert tfr_provider._roi_tracker.get(session_key)['frames'] == 0
+
+    # Next frames are analysed in the tracked region
+    for frames in [1, 2]:
+        result = tfr_provider.verify(request, models[user['learner_id']])
+        check_verification_result(result)
+        assert result.code == result.AlertCode.OK
+        assert abs(result.result - full_result.result) < 0.05
+        assert tfr_provider._roi_tracker.get(session_key)['frames'] == frames
+
+    # Full frame is analysed after the configured interval
+    tfr_provider.verify(request, models[user['learner_id']])
+    assert tfr_provider._roi_tracker.get(session_key)['frames'] == 0
+
+    # Tracking is reset when multiple faces are found
+    request = get_request(image='multiple_faces', learner_id=user['learner_id'], session_id=3)
+    tfr_provider.verify(request, models[user['learner_id']])
+    assert tfr_provider._roi_tracker.get(session_key) is None
+    tfr_provider.set_options({'roi_tracking': False})
+
+
+@pytest.mark.dependency(depends=["test_progressive_enrolment"], scope='module')
+def test_verify_adaptive_jitter(tfr_provider, mocker):
+    import face_recognition
+    user = users[0]
+    if user['learner_id'] not in models:
+        pytest.skip(PYTEST_MISSING_MODELS_MSG)
+
+    request = get_request(image=user['test'][0], learner_id=user['learner_id'])
+    fixed_result = tfr_provider.verify(request, models[user['learner_id']])
+
+    tfr_provider.set_options({'verification_jitter_policy': 'adaptive', 'adaptive_jitter_band': 0.05})
+    alert_below = tfr_provider.info['alert_below']
+    assert tfr_provider._is_uncertain_score(alert_below + 0.01)
+    assert not tfr_provider._is_uncertain_score(alert_below + 0.1)
+
+    # Uncertain faces are encoded again with the full number of jitters
+    tfr_provider.set_options({'encoding_num_jitters': 3})
+    encodings_spy = mocker.spy(face_recognition, 'face_encodings')
+    mocker.patch.object(tfr_provider, '_is_uncertain_score', return_value=True)
+    result = tfr_provider.verify(request, models[user['learner_id']])
+    check_verification_result(result)
+    assert result.code == fixed_result.code
+    assert abs(result.result - fixed_result.result) < 0.05
+    assert encodings_spy.call_count == 2
+    assert encodings_spy.call_args_list[0][1]['num_jitters'] == 1
+    assert encodings_spy.call_args_list[1][1]['num_jitters'] == 3
+
+    # Certain faces are encoded only once
+    encodings_spy.reset_mock()
+    mocker.patch.object(tfr_provider, '_is_uncertain_score', return_value=False)
+    result = tfr_provider.verify(request, models[user['learner_id']])
+    check_verification_result(result)
+    assert result.code == fixed_result.code
+    assert encodings_spy.call_count == 1
+    assert encodings_spy.call_args_list[0][1]['num_jitters'] == 1
+
+
+@pytest.mark.dependency(depends=["test_progressive_enrolment"], scope='module')
+def test_verify_instrumentation(tfr_provider):
+    user = users[0]
+    if user['learner_id'] not in models:
+        pytest.skip(PYTEST_MISSING_MODELS_MSG)
+
+    request = get_request(image=user['test'][0], learner_id=user['learner_id'])
+    tfr_provider.verify(request, models[user['learner_id']])
+    assert tfr_provider.last_timings is None
+
+    reported = []
+    tfr_provider.set_options({'instrumentation': True})
+    tfr_provider.set_timing_hook(lambda operation, timings: reported.append((operation, timings)))
+    tfr_provider.verify(request, models[user['learner_id']])
+    for stage in ['model', 'decode', 'black_check', 'detection', 'encoding', 'distance', 'audit_image', 'total']:
+        assert tfr_provider.last_timings[stage] >= 0
+    assert reported[0][0] == 'verify'
+    assert reported[0][1] == tfr_provider.last_timings
+
+    tfr_provider.validate_sample(get_sample(image=user['test'][0]), validation_id=1)
+    assert reported[1][0] == 'validate_sample'
+    assert 'detection' in reported[1][1]
+    tfr_provider.set_options({'instrumentation': False})
+
+
+@pytest.mark.dependency(depends=["test_progressive_enrolment"], scope='module')
+def test_verify_audit_policy(tfr_provider, mocker):
+    from tfr.provider import utils
+    user = users[0]
+    if user['learner_id'] not in models:
+        pytest.skip(PYTEST_MISSING_MODELS_MSG)
+
+    face_image_spy = mocker.spy(utils, 'get_face_image')
+    request = get_request(image=user['test'][0], learner_id=user['learner_id'])
+    result = tfr_provider.verify(request, models[user['learner_id']])
+    assert face_image_spy.call_count == 1
+
+    # Clean results have no face images
+    tfr_provider.set_options({'audit_images': 'alerts'})
+    mocker.patch.dict(tfr_provider.info, {'warning_below': 0.0})
+    face_image_spy.reset_mock()
+    alerts_result = tfr_provider.verify(request, models[user['learner_id']])
+    check_verification_result(alerts_result)
+    assert abs(alerts_result.result - result.result) < 0.05
+    assert face_image_spy.call_count == 0
+
+    # Results with a score below the warning threshold have face images
+    mocker.patch.dict(tfr_provider.info, {'warning_below': 1.01})
+    tfr_provider.verify(request, models[user['learner_id']])
+    assert face_image_spy.call_count == 1
+
+    # Alerts have face images
+    mocker.patch.dict(tfr_provider.info, {'warning_below': 0.0})
+    face_image_spy.reset_mock()
+    request = get_request(image='multiple_faces', learner_id=user['learner_id'])
+    tfr_provider.verify(request, models[user['learner_id']])
+    assert face_image_spy.call_count > 1
+
+    face_image_spy.reset_mock()
+    tfr_provider.set_options({'audit_images': 'never'})
+    tfr_provider.verify(request, models[user['learner_id']])
+    assert face_image_spy.call_count == 0
+    tfr_provider.set_options({'audit_images': 'always'})
+
+
+def test_batch_enrolment_with_validation_encodings(tfr_provider, mocker):
+    import face_recognition
+    from tesla_ce_provider.models.parser import parse_validation_data
+    tfr_provider.set_options({'fast_validation': False, 'validation_encodings': True, 'min_enrol_samples': 3,
+                              'target_enrol_samples': 6})
+    user = users[0]
+    samples = []
+    for sample_id, img in enumerate(user['enrolment']):
+        sample = get_sample(image=img, sample_id=sample_id, learner_id=user['learner_id'])
+        val_result = tfr_provider.validate_sample(sample, validation_id=sample_id + 1)
+        if val_result.status == 1:
+            assert 'encoding' in val_result.info['info']
+            samples.append(get_sample(image=img, sample_id=sample_id, learner_id=user['learner_id'],
+                                      validations=[parse_validation_data(val_result.info)]))
+
+    # Validated encodings are used, without detecting faces or computing encodings again
+    locations_spy = mocker.spy(face_recognition, 'face_locations')
+    encodings_spy = mocker.spy(face_recognition, 'face_encodings')
+    result = tfr_provider.enrol(samples=samples, model=None)
+    check_enrolment_result(result)
+    assert result.valid
+    assert result.can_analyse
+    assert len(result.model['samples']) == len(samples)
+    assert locations_spy.call_count == 0
+    assert encodings_spy.call_count == 0
+
+    # Encodings computed with a different configuration are not used
+    tfr_provider.set_options({'encoding_num_jitters': 1})
+    result = tfr_provider.enrol(samples=samples[:1], model=None)
+    assert result.valid
+    assert encodings_spy.call_count == 1
+    tfr_provider.set_options({'validation_encodings': False, 'encoding_num_jitters': 5})
+
+
+@pytest.mark.dependency(depends=["test_progressive_enrolment"], scope='module')
+def test_verify_early_exit(tfr_provider):
+    user = users[0]
+    if user['learner_id'] not in models:
+        pytest.skip(PYTEST_MISSING_MODELS_MSG)
+
+    model = models[user['learner_id']]
+    request = get_request(image=user['test'][0], learner_id=user['learner_id'])
+    result = tfr_provider.verify(request, model)
+    face = result.audit['faces'][0]
+
+    # The first accepted reference is reported, which is not always the closest one
+    tfr_provider.set_options({'early_exit_distance': 1.0, 'search_block_size': 1})
+    early_result = tfr_provider.verify(request, model)
+    check_verification_result(early_result)
+    early_face = early_result.audit['faces'][0]
+    assert early_face['most_similar_sample'] == model['samples'][0]['id']
+    assert early_face['score'] <= face['score']
+    assert early_result.result <= result.result
+    tfr_provider.set_options({'early_exit_distance': 0, 'search_block_size': 64})
+
+
+@pytest.mark.dependency(depends=["test_progressive_enrolment"], scope='module')
+def test_verify_deadline(tfr_provider, mocker):
+    import time
+    import face_recognition
+    user = users[0]
+    if user['learner_id'] not in models:
+        pytest.skip(PYTEST_MISSING_MODELS_MSG)
+
+    request = get_request(image=user['test'][0], learner_id=user['learner_id'])
+    result = tfr_provider.verify(request, models[user['learner_id']])
+    assert 'PROVIDER_DEGRADED_PROCESSING' not in result.audit['warnings']
+
+    # Stale requests are processed with the cheapest settings
+    request._object['data']['metadata']['timestamp'] = time.time() - 60
+    tfr_provider.set_options({'verification_deadline': 30})
+    locations_spy = mocker.spy(face_recognition, 'face_locations')
+    encodings_spy = mocker.spy(face_recognition, 'face_encodings')
+    degraded_result = tfr_provider.verify(request, models[user['learner_id']])
+    check_verification_result(degraded_result)
+    assert degraded_result.code == result.code
+    assert abs(degraded_result.result - result.result) < 0.1
+    assert locations_spy.call_args_list[0][1]['model'] == 'hog'
+    assert encodings_spy.call_args_list[0][1]['num_jitters'] == 1
+    assert 'PROVIDER_DEGRADED_PROCESSING' in degraded_result.audit['warnings']
+    face = degraded_result.audit['faces'][0]
+    assert face['image'] is None
+    assert face['info']['degraded'] == ['detection', 'encoding', 'audit_image']
+
+    # Requests on time use configured settings
+    request._object['data']['metadata']['timestamp'] = time.time()
+    result = tfr_provider.verify(request, models[user['learner_id']])
+    assert 'PROVIDER_DEGRADED_PROCESSING' not in result.audit['warnings']
+    tfr_provider.set_options({'verification_deadline': 0})
+
+
+@pytest.mark.dependency(depends=["test_progressive_enrolment"], scope='module')
+def test_verify_batch_deadline(tfr_provider, mocker):
+    import time
+    import face_recognition
+    user = users[0]
+    if user['learner_id'] not in models:
+        pytest.skip(PYTEST_MISSING_MODELS_MSG)
+
+    images = [user['test'][0], user['enrolment'][1]]
+    requests = [get_request(image=img, learner_id=user['learner_id'], request_id=idx)
+                for idx, img in enumerate(images)]
+    batch_models = [models[user['learner_id']]] * len(requests)
+    tfr_provider.set_options({'verification_deadline': 30})
+    for result in tfr_provider.verify_batch(requests, batch_models):
+        assert 'PROVIDER_DEGRADED_PROCESSING' not in result.audit['warnings']
+
+    # A stale request makes the batch use the cheapest settings
+    requests[0]._object['data']['metadata']['timestamp'] = time.time() - 60
+    locations_spy = mocker.spy(face_recognition, 'face_locations')
+    encodings_spy = mocker.spy(face_recognition, 'face_encodings')
+    results = tfr_provider.verify_batch(requests, batch_models)
+    assert [call[1]['model'] for call in locations_spy.call_args_list] == ['hog', 'hog']
+    assert [call[1]['num_jitters'] for call in encodings_spy.call_args_list] == [1, 1]
+    for result in results:
+        check_verification_result(result)
+        assert result.code == result.AlertCode.OK
+        assert 'PROVIDER_DEGRADED_PROCESSING' in result.audit['warnings']
+        face = result.audit['faces'][0]
+        assert face['image'] is None
+        assert face['info']['degraded'] == ['detection', 'encoding', 'audit_image']
+    tfr_provider.set_options({'verification_deadline': 0})
@@ -13,6 +13,14 @@
 #      You should have received a copy of the GNU Affero General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ TeSLA CE Face Recognition package """
-from .provider import TFRProvider
 
 __all__ = ["TFRProvider"]
+
+
+def __getattr__(name):
+    # The provider is loaded on first access, as it requires the TeSLA CE client configuration. This allows to run
+    # modules of the package, like the benchmark, without a TeSLA CE deployment.
+    if name == 'TFRProvider':
+        from .provider import TFRProvider
+        return TFRProvider
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,868 @@
+#  Copyright (c) 2020 Xavier Baró
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Face Recognition benchmark module
+
+    Measure the performance of each stage of the provider hot paths. Usage:
+
+        python -m tfr.benchmark --iterations 20 --output results.json
+"""
+import argparse
+import base64
+import glob
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from io import BytesIO
+from types import SimpleNamespace
+import numpy as np
+import simplejson
+from PIL import Image
+
+#: Folder with the image bundled with the package
+PACKAGE_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+#: Folder with the test images, available in source distributions
+TEST_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'data')
+
+#: Registered benchmark stages
+STAGES = OrderedDict()
+
+
+def benchmark_stage(name, **kwargs):
+    """
+        Register a benchmark stage. Decorated function receives the benchmark context and the given keyword arguments,
+        and returns the function to measure, which receives the iteration number.
+        :param name: Stage name
+        :type name: str
+    """
+    def decorator(func):
+        STAGES[name] = (func, kwargs)
+        return func
+    return decorator
+
+
+class BenchmarkContext:
+    """
+        Data shared by benchmark stages
+    """
+    def __init__(self, data_path=None):
+        """
+            Load benchmark images
+            :param data_path: Folder with base64 encoded images (.b64 files)
+            :type data_path: str
+        """
+        if data_path is None:
+            data_path = TEST_DATA_PATH if os.path.exists(TEST_DATA_PATH) else PACKAGE_DATA_PATH
+
+        #: Images as data URIs
+        self.payloads = []
+        for image_file in sorted(glob.glob(os.path.join(data_path, '*.b64'))):
+            with open(image_file, 'r') as fd_image:
+                self.payloads.append(fd_image.read().strip())
+        if len(self.payloads) == 0:
+            raise FileNotFoundError('No images found in {}'.format(data_path))
+
+        self._images = None
+        self._faces = None
+        self._frames = {}
+
+    def get_payload(self, idx):
+        """
+            Get a data URI, cycling over the available images
+            :param idx: Iteration number
+            :type idx: int
+            :return: Image data URI
+            :rtype: str
+        """
+        return self.payloads[idx % len(self.payloads)]
+
+    def get_image(self, idx):
+        """
+            Get a decoded RGB image, cycling over the available images
+            :param idx: Iteration number
+            :type idx: int
+            :return: Image
+            :rtype: np.array
+        """
+        from .provider import utils
+        if self._images is None:
+            self._images = []
+            for payload in self.payloads:
+                image = np.array(Image.open(BytesIO(base64.b64decode(payload.split(',')[-1]))))
+                if image.ndim == 3 and image.shape[2] == 4:
+                    image = utils.remove_alpha(image)
+                self._images.append(np.ascontiguousarray(image))
+        return self._images[idx % len(self._images)]
+
+    def get_frame(self, idx, size, alpha=False):
+        """
+            Get a synthetic frame built by resizing an image, cycling over the available images
+            :param idx: Iteration number
+            :type idx: int
+            :param size: Frame size as (width, height)
+            :type size: tuple
+            :param alpha: Add a transparent border as alpha channel
+            :type alpha: bool
+            :return: Frame
+            :rtype: np.array
+        """
+        key = (idx % len(self.payloads), size, alpha)
+        if key not in self._frames:
+            frame = np.array(Image.fromarray(self.get_image(idx)).resize(size, Image.BILINEAR))
+            if alpha:
+                alpha_channel = np.zeros(frame.shape[:2], dtype=np.uint8)
+                alpha_channel[size[1] // 10:-size[1] // 10, size[0] // 10:-size[0] // 10] = 255
+                frame = np.dstack([frame, alpha_channel])
+            self._frames[key] = frame
+        return self._frames[key]
+
+    @property
+    def num_faces(self):
+        """
+            Number of images with a single face
+            :return: Number of images
+            :rtype: int
+        """
+        self.get_face(0)
+        return len(self._faces)
+
+    def get_face_frame(self, idx, size):
+        """
+            Get a synthetic frame with a single face, built by placing an image at the centre of a larger frame, with
+            half of its height, cycling over the available images
+            :param idx: Iteration number
+            :type idx: int
+            :param size: Frame size as (width, height)
+            :type size: tuple
+            :return: Frame
+            :rtype: np.array
+        """
+        key = ('face', idx % self.num_faces, size)
+        if key not in self._frames:
+            image = Image.fromarray(self.get_face(idx)[0])
+            height = size[1] // 2
+            image = image.resize((image.width * height // image.height, height), Image.BILINEAR)
+            frame = Image.new('RGB', size, (128, 128, 128))
+            frame.paste(image, ((size[0] - image.width) // 2, (size[1] - image.height) // 2))
+            self._frames[key] = np.array(frame)
+        return self._frames[key]
+
+    def get_face(self, idx):
+        """
+            Get an image with a single face and its location, cycling over the available images
+            :param idx: Iteration number
+            :type idx: int
+            :return: Image and face location
+            :rtype: tuple
+        """
+        import face_recognition
+        if self._faces is None:
+            self._faces = []
+            for img_idx in range(len(self.payloads)):
+                image = self.get_image(img_idx)
+                locations = face_recognition.face_locations(image, number_of_times_to_upsample=1, model='hog')
+                if len(locations) == 1:
+                    self._faces.append((image, locations))
+            if len(self._faces) == 0:
+                raise ValueError('No images with a single face are available')
+        return self._faces[idx % len(self._faces)]
+
+
+def get_peak_rss():
+    """
+        Get the peak resident set size of the current process
+        :return: Peak RSS in bytes
+        :rtype: int
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def measure(func, iterations, warmup=1):
+    """
+        Measure the execution time of a function
+        :param func: Function to measure. It receives the iteration number
+        :param iterations: Number of measured executions
+        :type iterations: int
+        :param warmup: Number of executions before starting the measure
+        :type warmup: int
+        :return: Timing statistics
+        :rtype: dict
+    """
+    for idx in range(warmup):
+        func(idx)
+    timings = np.zeros(iterations)
+    for idx in range(iterations):
+        start = time.perf_counter()
+        func(idx)
+        timings[idx] = time.perf_counter() - start
+    total = float(np.sum(timings))
+    return {
+        'iterations': iterations,
+        'total_s': total,
+        'throughput_per_s': iterations / total if total > 0 else None,
+        'mean_ms': float(np.mean(timings)) * 1000.0,
+        'p50_ms': float(np.percentile(timings, 50)) * 1000.0,
+        'p95_ms': float(np.percentile(timings, 95)) * 1000.0,
+        'p99_ms': float(np.percentile(timings, 99)) * 1000.0,
+    }
+
+
+def measure_memory(func, idx=0):
+    """
+        Measure the peak memory allocated by Python and numpy during the execution of a function
+        :param func: Function to measure. It receives the iteration number
+        :param idx: Iteration number passed to the function
+        :type idx: int
+        :return: Peak of allocated memory in bytes
+        :rtype: int
+    """
+    tracemalloc.start()
+    try:
+        func(idx)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def get_subprocess_env():
+    """
+        Get the environment to run benchmark code in a new interpreter, with the package sources in the path. The
+        TeSLA CE client configuration is not required, as the benchmark does not connect to a TeSLA CE deployment.
+        :return: Environment variables
+        :rtype: dict
+    """
+    src_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([src_path] + [path for path in [env.get('PYTHONPATH')] if path])
+    env.setdefault('DEBUG', '1')
+    return env
+
+
+def get_private_memory():
+    """
+        Get the memory of the current process that is not shared with other processes (Linux only)
+        :return: Private memory in bytes, or None if it cannot be measured
+        :rtype: int
+    """
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as fd_smaps:
+            lines = fd_smaps.readlines()
+    except OSError:
+        return None
+    private = 0
+    for line in lines:
+        if line.startswith('Private_Clean:') or line.startswith('Private_Dirty:'):
+            private += int(line.split()[1]) * 1024
+    return private
+
+
+def _child_memory_task(queue):
+    """
+        Load the face models and the provider in a forked process and report its private memory
+        :param queue: Queue where the private memory is sent
+        :type queue: multiprocessing.Queue
+    """
+    from .provider import utils
+    from .provider.tfr import face_recognition, TFRProvider
+    utils.load_lazy_module(face_recognition)
+    TFRProvider()
+    queue.put(get_private_memory())
+
+
+def child_memory_main(preload, num_children):
+    """
+        Fork worker processes, optionally loading the face models before forking, and print the private memory of
+        each child as JSON. It must be executed in a new interpreter, without the models loaded.
+        :param preload: Load the models in the parent process before forking
+        :type preload: bool
+        :param num_children: Number of child processes
+        :type num_children: int
+    """
+    import multiprocessing
+    if preload:
+        from .worker import preload as preload_models
+        preload_models()
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    children = [context.Process(target=_child_memory_task, args=(queue, )) for _ in range(num_children)]
+    for child in children:
+        child.start()
+    private = [queue.get() for _ in children]
+    for child in children:
+        child.join()
+    print(simplejson.dumps(private))
+
+
+def measure_child_memory(num_children=2):
+    """
+        Measure the private memory of forked worker processes, with and without loading the face models in the
+        parent process. Each configuration is measured in a new interpreter.
+        :param num_children: Number of child processes
+        :type num_children: int
+        :return: Mean private memory of a child in bytes for each configuration, or None if it cannot be measured
+        :rtype: dict
+    """
+    if get_private_memory() is None:
+        return None
+    env = get_subprocess_env()
+    results = OrderedDict()
+    for name, preload in [('lazy', False), ('preloaded', True)]:
+        output = subprocess.run([sys.executable, '-c', 'from tfr.benchmark import child_memory_main; '
+                                 'child_memory_main({}, {})'.format(preload, num_children)],
+                                env=env, check=True, stdout=subprocess.PIPE).stdout
+        private = simplejson.loads(output.decode().strip().splitlines()[-1])
+        results[name] = {
+            'children': num_children,
+            'mean_private_bytes': float(np.mean(private)),
+        }
+    return results
+
+
+def _layout_task(num_threads, iterations, model, start_event):
+    """
+        Process faces in a forked worker process of a layout benchmark
+        :param num_threads: Number of compute threads of the worker
+        :type num_threads: int
+        :param iterations: Number of processed images
+        :type iterations: int
+        :param model: Face detection model
+        :type model: str
+        :param start_event: Event set when all the workers are ready
+        :type start_event: multiprocessing.Event
+    """
+    from .provider import TFRProvider
+    provider = TFRProvider()
+    provider.set_options({'model': model, 'compute_threads': num_threads})
+    context = BenchmarkContext()
+    context.get_face(0)
+    start_event.wait()
+    for idx in range(iterations):
+        image, _ = context.get_face(idx)
+        provider._encode_faces(image, provider._find_faces(image))
+
+
+def layout_main(num_workers, num_threads, iterations, model):
+    """
+        Run a layout benchmark with several worker processes, and print the throughput as JSON. It must be executed
+        in a new interpreter, with the thread limit set in TFR_COMPUTE_THREADS.
+        :param num_workers: Number of worker processes
+        :type num_workers: int
+        :param num_threads: Number of compute threads of each worker
+        :type num_threads: int
+        :param iterations: Number of images processed by each worker
+        :type iterations: int
+        :param model: Face detection model
+        :type model: str
+    """
+    import multiprocessing
+    from .worker import preload
+    preload()
+    context = multiprocessing.get_context('fork')
+    start_event = context.Event()
+    workers = [context.Process(target=_layout_task, args=(num_threads, iterations, model, start_event))
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    # Give the workers time to load the images and find the sample faces
+    time.sleep(1.0)
+    start = time.perf_counter()
+    start_event.set()
+    for worker in workers:
+        worker.join()
+    total = time.perf_counter() - start
+    print(simplejson.dumps({
+        'workers': num_workers,
+        'threads': num_threads,
+        'images': num_workers * iterations,
+        'total_s': total,
+        'throughput_per_s': num_workers * iterations / total
+    }))
+
+
+def measure_layouts(layouts, iterations=10, model='hog'):
+    """
+        Measure the throughput of face detection and encoding with several worker x thread layouts. Each layout is
+        measured in a new interpreter.
+        :param layouts: List of layouts as (number of workers, number of threads per worker)
+        :type layouts: list
+        :param iterations: Number of images processed by each worker
+        :type iterations: int
+        :param model: Face detection model
+        :type model: str
+        :return: Throughput for each layout
+        :rtype: dict
+    """
+    results = OrderedDict()
+    for num_workers, num_threads in layouts:
+        env = get_subprocess_env()
+        env['TFR_COMPUTE_THREADS'] = str(num_threads)
+        output = subprocess.run([sys.executable, '-c', 'from tfr.benchmark import layout_main; '
+                                 'layout_main({}, {}, {}, {!r})'.format(num_workers, num_threads, iterations, model)],
+                                env=env, check=True, stdout=subprocess.PIPE).stdout
+        results['{}x{}'.format(num_workers, num_threads)] = simplejson.loads(output.decode().strip().splitlines()[-1])
+    return results
+
+
+def get_provider(options):
+    """
+        Create a provider for the benchmark stages, without logging
+        :param options: Provider options
+        :type options: dict
+        :return: Provider
+        :rtype: tfr.provider.TFRProvider
+    """
+    from .provider.tfr import TFRProvider
+    provider = TFRProvider()
+    provider.set_logger(None)
+    provider.set_options(options)
+    return provider
+
+
+def get_random_model(num_samples):
+    """
+        Create a model with random encodings
+        :param num_samples: Number of samples in the model
+        :type num_samples: int
+        :return: Model and its encodings
+        :rtype: tuple
+    """
+    from .provider.models import ENCODING_SIZE, MODEL_FORMAT_VERSION, encode_features
+    encodings = np.random.RandomState(0).uniform(-0.3, 0.3, (num_samples, ENCODING_SIZE))
+    model = {
+        'percentage': 1.0,
+        'samples': [{'id': idx, 'features': None} for idx in range(num_samples)],
+        'data': {
+            'version': MODEL_FORMAT_VERSION,
+            'dtype': 'float32',
+            'shape': [num_samples, ENCODING_SIZE],
+            'encodings': encode_features(encodings)
+        }
+    }
+    return model, encodings
+
+
+def legacy_get_sample_image(sample):
+    """
+        Image decoding as done in previous versions, to compare with the current implementation
+        :param sample: Sample structure
+        :return: Image
+        :rtype: np.array
+    """
+    buffer = BytesIO()
+    buffer.write(base64.b64decode(sample.data.split(',')[1]))
+    buffer.flush()
+    im_array = np.array(Image.open(buffer))
+    if np.shape(im_array)[2] == 4:
+        im_array = legacy_remove_alpha(im_array)
+    return im_array
+
+
+def legacy_remove_alpha(im_array):
+    """
+        Alpha removal as done in previous versions, to compare with the current implementation
+        :param im_array: RGBA image
+        :type im_array: np.array
+        :return: RGB image
+        :rtype: np.array
+    """
+    chanel_r, chanel_g, chanel_b, chanel_a = np.rollaxis(im_array, axis=-1)
+    chanel_r[chanel_a == 0] = 0
+    chanel_g[chanel_a == 0] = 0
+    chanel_b[chanel_a == 0] = 0
+    return np.dstack([chanel_r, chanel_g, chanel_b])
+
+
+def legacy_is_black_image(img):
+    """
+        Black image check as done in previous versions, to compare with the current implementation
+        :param img: Image to check
+        :type img: np.array
+        :return: True if the image is black or False otherwise
+        :rtype: bool
+    """
+    extrema = Image.fromarray(img).convert("L").getextrema()
+    return extrema[0] == 0 and extrema[1] < 5
+
+
+def legacy_get_face_image(image, face_locations):
+    """
+        Audit face image generation as done in previous versions, to compare with the current implementation
+        :param image: The source image
+        :type image: np.array
+        :param face_locations: Face location as (top, right, bottom, left)
+        :type face_locations: tuple
+        :return: Face image in JPEG format
+        :rtype: str
+    """
+    img = Image.fromarray(image)
+    face_img = img.crop((face_locations[3], face_locations[0], face_locations[1], face_locations[2]))
+    buffer = BytesIO()
+    face_img.save(buffer, format='jpeg')
+    buffer.flush()
+    return 'data:image/jpeg;base64,{}'.format(base64.b64encode(buffer.getvalue()).decode('utf-8'))
+
+
+@benchmark_stage('base64_decode')
+def _stage_base64_decode(context):
+    return lambda idx: base64.b64decode(context.get_payload(idx).split(',')[-1])
+
+
+@benchmark_stage('pil_decode')
+def _stage_pil_decode(context):
+    buffers = [base64.b64decode(payload.split(',')[-1]) for payload in context.payloads]
+
+    def run(idx):
+        Image.open(BytesIO(buffers[idx % len(buffers)])).load()
+    return run
+
+
+@benchmark_stage('sample_decode_legacy', legacy=True)
+@benchmark_stage('sample_decode', legacy=False)
+def _stage_sample_decode(context, legacy):
+    from .provider import utils
+    samples = [SimpleNamespace(data=payload) for payload in context.payloads]
+    get_sample_image = legacy_get_sample_image if legacy else utils.get_sample_image
+    return lambda idx: get_sample_image(samples[idx % len(samples)])
+
+
+@benchmark_stage('rgba_conversion')
+def _stage_rgba_conversion(context):
+    from .provider import utils
+    images = []
+    for idx in range(len(context.payloads)):
+        image = context.get_image(idx)
+        images.append(np.dstack([image, np.full(image.shape[:2], 255, dtype=np.uint8)]))
+    return lambda idx: utils.remove_alpha(images[idx % len(images)])
+
+
+@benchmark_stage('rgba_conversion_1080p_legacy', size=(1920, 1080), legacy=True)
+@benchmark_stage('rgba_conversion_1080p', size=(1920, 1080), legacy=False)
+@benchmark_stage('rgba_conversion_720p_legacy', size=(1280, 720), legacy=True)
+@benchmark_stage('rgba_conversion_720p', size=(1280, 720), legacy=False)
+def _stage_rgba_conversion_frame(context, size, legacy):
+    from .provider import utils
+    frames = [context.get_frame(idx, size, alpha=True) for idx in range(len(context.payloads))]
+    if legacy:
+        # Previous implementation modifies the input image
+        return lambda idx: legacy_remove_alpha(frames[idx % len(frames)].copy())
+    return lambda idx: utils.remove_alpha(frames[idx % len(frames)])
+
+
+@benchmark_stage('black_check')
+def _stage_black_check(context):
+    from .provider import utils
+    return lambda idx: utils.is_black_image(context.get_image(idx))
+
+
+@benchmark_stage('black_check_1080p_legacy', size=(1920, 1080), legacy=True)
+@benchmark_stage('black_check_1080p', size=(1920, 1080), legacy=False)
+@benchmark_stage('black_check_720p_legacy', size=(1280, 720), legacy=True)
+@benchmark_stage('black_check_720p', size=(1280, 720), legacy=False)
+def _stage_black_check_frame(context, size, legacy):
+    from .provider import utils
+    is_black_image = legacy_is_black_image if legacy else utils.is_black_image
+    frames = [context.get_frame(idx, size) for idx in range(len(context.payloads))]
+    return lambda idx: is_black_image(frames[idx % len(frames)])
+
+
+@benchmark_stage('detection_cnn', model='cnn')
+@benchmark_stage('detection_hog', model='hog')
+def _stage_detection(context, model):
+    import face_recognition
+    return lambda idx: face_recognition.face_locations(context.get_image(idx), number_of_times_to_upsample=1,
+                                                       model=model)
+
+
+@benchmark_stage('encoding_jitter_10', num_jitters=10)
+@benchmark_stage('encoding_jitter_5', num_jitters=5)
+@benchmark_stage('encoding_jitter_1', num_jitters=1)
+def _stage_encoding(context, num_jitters):
+    import face_recognition
+
+    def run(idx):
+        image, locations = context.get_face(idx)
+        face_recognition.face_encodings(image, locations, num_jitters=num_jitters)
+    return run
+
+
+@benchmark_stage('distance_1000', num_samples=1000)
+@benchmark_stage('distance_100', num_samples=100)
+@benchmark_stage('distance_10', num_samples=10)
+def _stage_distance(context, num_samples):
+    from .provider.models import FRSimpleModel, ENCODING_SIZE, MODEL_FORMAT_VERSION, encode_features
+    rng = np.random.RandomState(0)
+    model = FRSimpleModel({
+        'percentage': 1.0,
+        'samples': [{'id': idx, 'features': None} for idx in range(num_samples)],
+        'data': {
+            'version': MODEL_FORMAT_VERSION,
+            'dtype': 'float32',
+            'shape': [num_samples, ENCODING_SIZE],
+            'encodings': encode_features(rng.uniform(-0.3, 0.3, (num_samples, ENCODING_SIZE)))
+        }
+    })
+    model.get_encodings()
+    faces = rng.uniform(-0.3, 0.3, (16, ENCODING_SIZE))
+    return lambda idx: int(np.argmin(model.get_distances(faces[idx % len(faces)])))
+
+
+@benchmark_stage('search_1000_early_exit', num_samples=1000, num_faces=4, accept_distance=0.1)
+@benchmark_stage('search_1000', num_samples=1000, num_faces=4, accept_distance=0)
+@benchmark_stage('search_1000_legacy', num_samples=1000, num_faces=4, legacy=True)
+def _stage_search(context, num_samples, num_faces, accept_distance=0, legacy=False):
+    from .provider.models import FRSimpleModel, ENCODING_SIZE, MODEL_FORMAT_VERSION, encode_features
+    rng = np.random.RandomState(0)
+    encodings = rng.uniform(-0.3, 0.3, (num_samples, ENCODING_SIZE))
+    model = FRSimpleModel({
+        'percentage': 1.0,
+        'samples': [{'id': idx, 'features': None} for idx in range(num_samples)],
+        'data': {
+            'version': MODEL_FORMAT_VERSION,
+            'dtype': 'float32',
+            'shape': [num_samples, ENCODING_SIZE],
+            'encodings': encode_features(encodings)
+        }
+    })
+    model.get_encodings()
+    # Faces of the enrolled learner, close to references spread over the model
+    faces = encodings[rng.randint(0, num_samples, (16, num_faces))] + rng.uniform(-0.001, 0.001,
+                                                                                  (16, num_faces, ENCODING_SIZE))
+    if legacy:
+        # One distance vector for each face, as done in previous versions
+        return lambda idx: [int(np.argmin(model.get_distances(face))) for face in faces[idx % len(faces)]]
+    return lambda idx: model.search(faces[idx % len(faces)], accept_distance)
+
+
+@benchmark_stage('model_load_legacy_format', num_samples=40, cache_size=256, legacy=True)
+@benchmark_stage('model_load_cached', num_samples=40, cache_size=256)
+@benchmark_stage('model_load', num_samples=40, cache_size=0)
+def _stage_model_load(context, num_samples, cache_size, legacy=False):
+    provider = get_provider({'model_cache_size': cache_size})
+    model, encodings = get_random_model(num_samples)
+    if legacy:
+        model = simplejson.loads(simplejson.dumps({
+            'percentage': 1.0,
+            'samples': [{'id': idx, 'features': encodings[idx].tolist()} for idx in range(num_samples)],
+            'data': None
+        }))
+        return lambda idx: provider._load_model('learner', dict(model)).get_encodings()
+
+    def run(idx):
+        # Each request has a new copy of the model, as read from the storage
+        data = dict(model['data'], encodings=(model['data']['encodings'] + ' ')[:-1])
+        provider._load_model('learner', dict(model, data=data)).get_encodings()
+    return run
+
+
+@benchmark_stage('coarse_detection', size=(1280, 720), max_side=640)
+@benchmark_stage('coarse_detection_legacy', size=(1280, 720), max_side=0)
+def _stage_coarse_detection(context, size, max_side):
+    provider = get_provider({'model': 'hog', 'detection_max_side': max_side})
+    frames = [context.get_face_frame(idx, size) for idx in range(context.num_faces)]
+    return lambda idx: provider._find_faces(frames[idx % len(frames)])
+
+
+@benchmark_stage('cascade_detection', model='cascade')
+@benchmark_stage('cascade_detection_legacy', model='cnn')
+def _stage_cascade_detection(context, model):
+    # Without upsampling, as the cnn detector with upsampling requires several GB for the larger images
+    provider = get_provider({'model': model, 'upsample_times': 0})
+    return lambda idx: provider._find_faces(context.get_face(idx)[0])
+
+
+@benchmark_stage('quality_gate_1080p', size=(1920, 1080))
+@benchmark_stage('quality_gate_720p', size=(1280, 720))
+def _stage_quality_gate(context, size):
+    provider = get_provider({'quality_gate': 'warn'})
+    frames = [context.get_frame(idx, size) for idx in range(len(context.payloads))]
+    return lambda idx: provider._check_quality(frames[idx % len(frames)])
+
+
+@benchmark_stage('verify_batch', size=(480, 360), batch_size=4, batch=True)
+@benchmark_stage('verify_batch_legacy', size=(480, 360), batch_size=4, batch=False)
+def _stage_verify_batch(context, size, batch_size, batch):
+    from tesla_ce_provider.models.base import Request
+    # Repeated frames must be processed each time
+    provider = get_provider({'model': 'cnn', 'upsample_times': 0, 'frame_cache_size': 0})
+    model, _ = get_random_model(40)
+    requests = []
+    for idx in range(context.num_faces):
+        buffer = BytesIO()
+        Image.fromarray(context.get_face_frame(idx, size)).save(buffer, format='jpeg')
+        requests.append(Request({'id': idx, 'learner_id': 'learner', 'data': {
+            'learner_id': 'learner',
+            'data': 'data:image/jpeg;base64,{}'.format(base64.b64encode(buffer.getvalue()).decode('utf-8')),
+            'metadata': {'mimetype': 'image/jpeg'}
+        }}))
+
+    def run(idx):
+        batch_requests = [requests[(idx + offset) % len(requests)] for offset in range(batch_size)]
+        if batch:
+            provider.verify_batch(batch_requests, [model] * batch_size)
+        else:
+            for request in batch_requests:
+                provider.verify(request, model)
+    return run
+
+
+@benchmark_stage('roi_tracking', size=(1280, 720), session_frames=10, tracking=True)
+@benchmark_stage('roi_tracking_legacy', size=(1280, 720), session_frames=10, tracking=False)
+def _stage_roi_tracking(context, size, session_frames, tracking):
+    provider = get_provider({'model': 'hog', 'roi_full_frame_interval': session_frames})
+    frames = [context.get_face_frame(idx, size) for idx in range(context.num_faces)]
+
+    def run(idx):
+        # Each image is repeated as consecutive frames of a session
+        session_id = (idx // session_frames) % len(frames)
+        if tracking:
+            provider._find_session_faces(frames[session_id], ('learner', session_id))
+        else:
+            provider._find_faces(frames[session_id])
+    return run
+
+
+@benchmark_stage('audit_image_thumbnail', max_side=96)
+@benchmark_stage('audit_image_legacy', legacy=True)
+@benchmark_stage('audit_image')
+def _stage_audit_image(context, legacy=False, max_side=0):
+    from .provider import utils
+
+    def run(idx):
+        image, locations = context.get_face(idx)
+        if legacy:
+            legacy_get_face_image(image, locations[0])
+        else:
+            utils.get_face_image(image, locations[0], max_side=max_side)
+    return run
+
+
+#: Code executed in a new process to measure each startup step
+STARTUP_STEPS = {
+    'import': 'import tfr.provider',
+    'provider': 'import tfr.provider; tfr.TFRProvider()',
+    'models': 'import tfr.provider; tfr.provider.tfr.face_recognition.face_locations',
+    'warm_up': 'import tfr.provider; tfr.TFRProvider().warm_up()',
+}
+
+
+@benchmark_stage('startup_warm_up', step='warm_up')
+@benchmark_stage('startup_models', step='models')
+@benchmark_stage('startup_provider', step='provider')
+@benchmark_stage('startup_import', step='import')
+def _stage_startup(context, step):
+    # Each execution starts a new interpreter, so it also includes the Python startup time
+    env = get_subprocess_env()
+    return lambda idx: subprocess.run([sys.executable, '-c', STARTUP_STEPS[step]], env=env, check=True)
+
+
+def run_benchmark(stages=None, iterations=20, warmup=1, data_path=None, child_memory=False, layouts=None):
+    """
+        Run the benchmark stages
+        :param stages: Name of the stages to run. If not provided, all stages are executed
+        :type stages: list
+        :param iterations: Number of measured executions for each stage
+        :type iterations: int
+        :param warmup: Number of executions before starting the measure
+        :type warmup: int
+        :param data_path: Folder with the benchmark images
+        :type data_path: str
+        :param child_memory: Measure the private memory of forked worker processes
+        :type child_memory: bool
+        :param layouts: List of worker x thread layouts to measure, as (number of workers, number of threads)
+        :type layouts: list
+        :return: Benchmark results
+        :rtype: dict
+    """
+    if stages is None:
+        stages = list(STAGES.keys())
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError('Unknown benchmark stage: {}'.format(stage))
+
+    context = BenchmarkContext(data_path)
+    results = OrderedDict()
+    for stage in stages:
+        func, kwargs = STAGES[stage]
+        stage_func = func(context, **kwargs)
+        results[stage] = measure(stage_func, iterations, warmup)
+        results[stage]['peak_alloc_bytes'] = measure_memory(stage_func)
+        results[stage]['peak_rss_bytes'] = get_peak_rss()
+
+    with open(os.path.join(PACKAGE_DATA_PATH, 'VERSION'), 'r') as fd_version:
+        version = fd_version.read().strip()
+    benchmark = {
+        'version': version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'num_images': len(context.payloads),
+        'stages': results,
+        'peak_rss_bytes': get_peak_rss()
+    }
+    if child_memory:
+        benchmark['child_memory'] = measure_child_memory()
+    if layouts:
+        benchmark['layouts'] = measure_layouts(layouts, iterations)
+    return benchmark
+
+
+def main(argv=None):
+    """
+        Benchmark command line entry point
+        :param argv: Command line arguments
+        :type argv: list
+    """
+    parser = argparse.ArgumentParser(description='TeSLA CE Face Recognition provider benchmark')
+    parser.add_argument('--stages', default=None,
+                        help='Comma separated list of stages. Available: {}'.format(', '.join(STAGES.keys())))
+    parser.add_argument('--iterations', type=int, default=20, help='Number of measured executions for each stage')
+    parser.add_argument('--warmup', type=int, default=1, help='Number of executions before measuring')
+    parser.add_argument('--data', default=None, help='Folder with base64 encoded images (.b64 files)')
+    parser.add_argument('--output', default=None, help='Output JSON file. If not provided, results are printed')
+    parser.add_argument('--child-memory', action='store_true',
+                        help='Measure the private memory of forked worker processes, with and without preloading')
+    parser.add_argument('--layouts', default=None,
+                        help='Comma separated list of worker x thread layouts to measure (i.e. 1x4,2x2,4x1)')
+    args = parser.parse_args(argv)
+
+    # The provider modules are loaded without the TeSLA CE client configuration
+    os.environ.setdefault('DEBUG', '1')
+
+    stages = None
+    if args.stages is not None:
+        stages = [stage.strip() for stage in args.stages.split(',') if len(stage.strip()) > 0]
+    layouts = None
+    if args.layouts is not None:
+        layouts = [tuple(int(value) for value in layout.strip().split('x'))
+                   for layout in args.layouts.split(',') if len(layout.strip()) > 0]
+    results = run_benchmark(stages, args.iterations, args.warmup, args.data, args.child_memory, layouts)
+
+    if args.output is None:
+        print(simplejson.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as fd_output:
+            simplejson.dump(results, fd_output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#  Copyright (c) 2020 Xavier Baró
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Face Recognition cache module """
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+        Bounded in-process cache with Least Recently Used eviction and optional expiration of entries
+    """
+    def __init__(self, max_size=128, ttl=None):
+        """
+            Create a new cache
+            :param max_size: Maximum number of entries. If 0, the cache is disabled
+            :type max_size: int
+            :param ttl: Time to live of the entries in seconds. If None or 0, entries never expire
+            :type ttl: float
+        """
+        #: Cached entries as key => (expiration time, value)
+        self._entries = OrderedDict()
+
+        #: Lock to protect the entries
+        self._lock = threading.Lock()
+
+        #: Maximum number of entries
+        self._max_size = 0
+
+        #: Time to live for entries
+        self._ttl = None
+
+        #: Statistics
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+        self.configure(max_size, ttl)
+
+    @property
+    def max_size(self):
+        """
+            Maximum number of entries in the cache
+            :rtype: int
+        """
+        return self._max_size
+
+    @property
+    def enabled(self):
+        """
+            Whether the cache is enabled or not
+            :rtype: bool
+        """
+        return self._max_size > 0
+
+    def configure(self, max_size=None, ttl=None):
+        """
+            Change cache parameters. Entries exceeding the new size are evicted.
+            :param max_size: Maximum number of entries. If 0, the cache is disabled
+            :type max_size: int
+            :param ttl: Time to live of the entries in seconds. If 0, entries never expire
+            :type ttl: float
+        """
+        with self._lock:
+            if max_size is not None:
+                self._max_size = max(0, int(max_size))
+            if ttl is not None:
+                self._ttl = ttl if ttl > 0 else None
+            self._evict()
+
+    def get(self, key, default=None):
+        """
+            Get an entry from the cache
+            :param key: Entry key
+            :param default: Value returned if the entry is not in the cache
+            :return: Cached value or the default value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self._expirations += 1
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """
+            Add an entry to the cache, evicting the least recently used entries if needed
+            :param key: Entry key
+            :param value: Value to store
+        """
+        with self._lock:
+            if self._max_size == 0:
+                return
+            expiration = None
+            if self._ttl is not None:
+                expiration = time.monotonic() + self._ttl
+            self._entries[key] = (expiration, value)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def pop(self, key, default=None):
+        """
+            Remove an entry from the cache
+            :param key: Entry key
+            :param default: Value returned if the entry is not in the cache
+            :return: Removed value or the default value
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            return entry[1]
+
+    def clear(self):
+        """
+            Remove all entries from the cache
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+            Get the cache statistics
+            :return: Cache size and hit, miss and eviction counters
+            :rtype: dict
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self._max_size,
+                'ttl': self._ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations
+            }
+
+    def _evict(self):
+        """
+            Remove least recently used entries until the size limit is satisfied
+        """
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
@@ -0,0 +1,24 @@
+#  Copyright (c) 2020 Xavier Baró
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Face Recognition messages module """
+from enum import Enum
+
+
+class TFRMessage(Enum):
+    """ Message codes of this provider that are not available in tesla_ce_provider.message.Provider """
+    #: Image rejected by the quality gate, or processed with a warning when the gate only warns
+    PROVIDER_LOW_QUALITY_IMAGE = 'PROVIDER_LOW_QUALITY_IMAGE'
+    #: Request processed with cheaper settings to meet its deadline
+    PROVIDER_DEGRADED_PROCESSING = 'PROVIDER_DEGRADED_PROCESSING'
@@ -13,17 +13,182 @@
 #      You should have received a copy of the GNU Affero General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ TeSLA CE Face Recognition models module """
+import base64
 from tesla_ce_provider.models import SimpleModel
 import numpy as np
 
+#: Size of the face encodings
+ENCODING_SIZE = 128
+
+#: Current version of the model serialization format
+MODEL_FORMAT_VERSION = 2
+
+#: Available data types to store encodings
+ENCODING_DTYPES = {
+    'float32': '<f4',
+    'float16': '<f2',
+}
+
+#: Default maximum number of prototypes kept by prototype models
+DEFAULT_MAX_PROTOTYPES = 16
+
+#: Available policies for samples with a near-duplicate encoding in the model
+DUPLICATE_POLICIES = ('keep', 'skip', 'replace')
+
+#: Number of reference encodings compared at once when searching with early exit
+SEARCH_BLOCK_SIZE = 64
+
+
+def encode_features(features, dtype='float32'):
+    """
+        Serialize a matrix of encodings as a base64 encoded binary blob
+
+        :param features: Encodings matrix
+        :type features: np.ndarray
+        :param dtype: Data type used to store the values. One of ENCODING_DTYPES
+        :type dtype: str
+        :return: Base64 representation of the encodings
+        :rtype: str
+    """
+    data = np.ascontiguousarray(features, dtype=ENCODING_DTYPES[dtype])
+    return base64.b64encode(data.tobytes()).decode('ascii')
+
+
+def decode_features(data, dtype='float32'):
+    """
+        Deserialize a matrix of encodings from a base64 encoded binary blob
+
+        :param data: Base64 representation of the encodings
+        :type data: str
+        :param dtype: Data type used to store the values. One of ENCODING_DTYPES
+        :type dtype: str
+        :return: Encodings matrix (N x 128)
+        :rtype: np.ndarray
+    """
+    features = np.frombuffer(base64.b64decode(data), dtype=ENCODING_DTYPES[dtype])
+    return features.astype(np.float32).reshape((-1, ENCODING_SIZE))
+
+
+def get_model_key(model_object):
+    """
+        Get a key identifying the content of a serialized model. The key is built from cheap identifiers and the hash
+        of the encodings text, so it is much faster than decoding the model. Legacy models, with the features stored
+        in the samples, are faster to decode than to identify, and have no key.
+
+        :param model_object: JSON representation of the model
+        :type model_object: dict
+        :return: Model key, or None for legacy models
+        :rtype: tuple
+    """
+    data = model_object.get('data')
+    if not isinstance(data, dict) or 'encodings' not in data:
+        return None
+    encodings = data['encodings']
+    return (model_object.get('percentage'), data.get('dtype'), data.get('mode'),
+            tuple(sample['id'] for sample in model_object.get('samples') or []), len(encodings), hash(encodings))
+
 
 class FRSimpleModel(SimpleModel):
     """
         Model for FaceRecognition based on a list of reference images
     """
     def __init__(self, model_object=None):
+        #: Matrix of reference encodings (N x 128), built on demand
+        self._encodings = None
+
+        #: Squared norm of each reference encoding
+        self._norms = None
+
+        #: Data type used to serialize the encodings
+        self._encodings_dtype = 'float32'
+
+        #: Number of samples added to the model, including the ones not stored as references
+        self._num_samples = 0
+
+        #: Policy for samples with a near-duplicate encoding in the model
+        self._duplicate_policy = 'keep'
+
+        #: Maximum distance to consider two encodings as duplicates
+        self._duplicate_distance = 0.0
+
         super().__init__(model_object=model_object)
 
+    def set_duplicate_policy(self, policy, distance):
+        """
+            Set how samples with an encoding close to an existing reference are added. With 'keep' all the samples
+            are stored, with 'skip' the new sample is not stored and with 'replace' it replaces the existing one. In
+            all cases the sample counts for the enrolment percentage.
+            :param policy: Duplicate policy. One of 'keep', 'skip' or 'replace'
+            :type policy: str
+            :param distance: Maximum distance to consider two encodings as duplicates
+            :type distance: float
+        """
+        if policy not in DUPLICATE_POLICIES:
+            raise ValueError('Invalid duplicate policy: {}'.format(policy))
+        self._duplicate_policy = policy
+        self._duplicate_distance = float(distance)
+
+    def set_encodings_dtype(self, dtype):
+        """
+            Set the data type used to store encodings when the model is serialized
+            :param dtype: Data type. One of 'float32' or 'float16'
+            :type dtype: str
+        """
+        if dtype not in ENCODING_DTYPES:
+            raise ValueError('Invalid encodings data type: {}'.format(dtype))
+        self._encodings_dtype = dtype
+
+    def load(self, model_object):
+        """
+            Load an object from a JSON representation. Both the binary format and the legacy
+            format, with the list of features in each sample, are accepted.
+            :param model_object: JSON representation of the object
+            :type model_object: dict
+            :return: Whether this object is a valid representation or not
+            :rtype: bool
+        """
+        self._set_encodings(None)
+        valid = super().load(model_object)
+        self._num_samples = len(self._samples)
+        if isinstance(self._data, dict) and 'num_samples' in self._data:
+            self._num_samples = self._data['num_samples']
+        return valid
+
+    def to_json(self):
+        """
+            Get a JSON representation of the object. Encodings are stored as a single binary blob
+            in the model data, and removed from the samples.
+            :return: JSON representation
+            :rtype: dict
+        """
+        model = super().to_json()
+        encodings = self.get_encodings()
+        model['samples'] = [{'id': sample['id'], 'features': None} for sample in self._samples]
+        model['data'] = {
+            'version': MODEL_FORMAT_VERSION,
+            'dtype': self._encodings_dtype,
+            'shape': list(encodings.shape),
+            'encodings': encode_features(encodings, self._encodings_dtype),
+            'num_samples': self._num_samples
+        }
+        return model
+
+    def can_analyse(self):
+        """
+            Check if current model is able to be used or need more enrolment samples
+            :return: True if this model can be used or False otherwise
+            :rtype: bool
+        """
+        return self._num_samples >= self._min_required_samples
+
+    def get_num_samples(self):
+        """
+            Get the number of samples added to the model, including the ones not stored as references
+            :return: Number of samples
+            :rtype: int
+        """
+        return self._num_samples
+
     def add_sample(self, sample, features=None):
         """
             Add given sample to model and update the enrolment percentage
@@ -32,17 +197,245 @@ class FRSimpleModel(SimpleModel):
             :param features: Optional provider representation for this sample
             :type features: dict
         """
-        # Change features to be serializable
-        features = features[0].tolist()
-        super().add_sample(sample, features)
+        encoding = np.asarray(features[0], dtype=np.float32).reshape((1, ENCODING_SIZE))
+        self._num_samples += 1
+        duplicate = self._find_duplicate(encoding[0])
+        if duplicate is None:
+            encodings = np.concatenate((self.get_encodings(), encoding))
+            # Features are stored in the encodings matrix
+            super().add_sample(sample, None)
+            self._set_encodings(encodings)
+        elif self._duplicate_policy == 'replace':
+            encodings = self.get_encodings().copy()
+            encodings[duplicate] = encoding[0]
+            # Samples list is rebuilt, as it can be shared with the loaded model object
+            self._samples = list(self._samples)
+            self._samples[duplicate] = {'id': sample.sample_id, 'features': None}
+            self._set_encodings(encodings)
+        self._percentage = min(1.0, float(self._num_samples) / float(self._required_samples))
+
+    def _find_duplicate(self, encoding):
+        """
+            Find a reference encoding that is a near-duplicate of a new encoding, if duplicates are not kept
+            :param encoding: Face encoding
+            :type encoding: np.ndarray
+            :return: Index of the closest reference, or None if there are no duplicates or they are kept
+            :rtype: int
+        """
+        if self._duplicate_policy == 'keep' or len(self._samples) == 0:
+            return None
+        distances = self.get_distances(encoding)
+        idx = int(np.argmin(distances))
+        if distances[idx] >= self._duplicate_distance:
+            return None
+        return idx
+
+    def _set_encodings(self, encodings):
+        """
+            Replace the encodings matrix and update the norms. If None is provided,
+            the matrix will be rebuilt from model data on next access.
+            :param encodings: Encodings matrix
+            :type encodings: np.ndarray
+        """
+        self._encodings = encodings
+        self._norms = None
+        if encodings is not None:
+            self._norms = np.einsum('ij,ij->i', encodings, encodings)
+
+    def _load_encodings(self):
+        """
+            Build the encodings matrix from the model data
+            :return: Encodings matrix (N x 128)
+            :rtype: np.ndarray
+        """
+        if isinstance(self._data, dict) and self._data.get('version') == MODEL_FORMAT_VERSION:
+            encodings = decode_features(self._data['encodings'], self._data['dtype'])
+            if encodings.shape[0] != len(self._samples):
+                raise ValueError('Invalid model. Number of encodings does not match the number of samples.')
+            return encodings
+        # Legacy format, with the list of features stored on each sample
+        encodings = np.array([sample['features'] for sample in self._samples], dtype=np.float32)
+        return encodings.reshape((len(self._samples), ENCODING_SIZE))
 
     def get_encodings(self):
         """
-            Get the list of keypoint encodings
+            Get the matrix of keypoint encodings, with one row for each sample in the model
+
+            :return: Encodings matrix (N x 128)
+            :rtype: np.ndarray
+        """
+        if self._encodings is None:
+            self._set_encodings(np.ascontiguousarray(self._load_encodings()))
+        return self._encodings
+
+    def get_distances(self, encoding):
+        """
+            Get the euclidean distance between given encoding and each sample in the model
+
+            :param encoding: Face encoding
+            :type encoding: np.ndarray
+            :return: Distance to each sample in the model
+            :rtype: np.ndarray
+        """
+        encodings = self.get_encodings()
+        encoding = np.asarray(encoding, dtype=np.float32)
+        # ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab, with all the products in a single call
+        distances = self._norms + np.dot(encoding, encoding) - 2.0 * np.dot(encodings, encoding)
+        return np.sqrt(np.maximum(distances, 0.0))
+
+    def search(self, encodings, accept_distance=0, block_size=SEARCH_BLOCK_SIZE):
+        """
+            Find the closest reference to each face encoding. All the faces are compared with a block of references
+            in a single matrix product. If an accept distance is given, the search stops after the first block where
+            every face has a reference closer than it. In that case, the returned reference is the closest one in the
+            searched blocks, which is not always the closest one of the model.
+
+            :param encodings: Face encodings (M x 128)
+            :type encodings: np.ndarray | list
+            :param accept_distance: If greater than 0, distance below which a reference is accepted as a match
+            :type accept_distance: float
+            :param block_size: Number of references compared at once
+            :type block_size: int
+            :return: Index of the closest found reference and its distance, for each face
+            :rtype: tuple
+        """
+        references = self.get_encodings()
+        faces = np.asarray(encodings, dtype=np.float32).reshape((-1, ENCODING_SIZE))
+        face_norms = np.einsum('ij,ij->i', faces, faces)
+        best_indexes = np.zeros(faces.shape[0], dtype=np.int64)
+        best_distances = np.full(faces.shape[0], np.inf, dtype=np.float32)
+        accept_distance = float(accept_distance) ** 2 if accept_distance > 0 else None
+        if accept_distance is None:
+            # Without early exit, all the references are compared at once
+            block_size = max(references.shape[0], 1)
+        # Faces without an accepted reference yet
+        pending = np.arange(faces.shape[0])
+        for start in range(0, references.shape[0], block_size):
+            block = slice(start, start + block_size)
+            # Squared distances (references x faces), as ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab
+            distances = np.dot(references[block], faces[pending].T)
+            distances *= -2.0
+            distances += self._norms[block, np.newaxis]
+            distances += face_norms[pending]
+            indexes = np.argmin(distances, axis=0)
+            block_distances = distances[indexes, np.arange(pending.shape[0])]
+            improved = block_distances < best_distances[pending]
+            best_distances[pending[improved]] = block_distances[improved]
+            best_indexes[pending[improved]] = indexes[improved] + start
+            if accept_distance is not None:
+                pending = pending[best_distances[pending] >= accept_distance]
+                if pending.shape[0] == 0:
+                    break
+        return best_indexes, np.sqrt(np.maximum(best_distances, 0.0))
+
+
+class FRPrototypeModel(FRSimpleModel):
+    """
+        Model for FaceRecognition based on a bounded set of representative reference images. All the enrolled samples
+        contribute to the enrolment percentage and the running mean encoding, but only the most representative ones
+        are kept as references.
+    """
+    def __init__(self, model_object=None):
+        #: Maximum number of reference encodings kept in the model
+        self._max_prototypes = DEFAULT_MAX_PROTOTYPES
+
+        #: Running mean of all the added encodings
+        self._mean = None
+
+        super().__init__(model_object=model_object)
+
+    def set_max_prototypes(self, max_prototypes):
+        """
+            Set the maximum number of reference encodings kept in the model
+            :param max_prototypes: Maximum number of reference encodings
+            :type max_prototypes: int
+        """
+        if max_prototypes < 1:
+            raise ValueError('Invalid number of prototypes: {}'.format(max_prototypes))
+        self._max_prototypes = int(max_prototypes)
+
+    def load(self, model_object):
+        """
+            Load an object from a JSON representation. Models stored with all the samples are also accepted, and
+            reduced to the maximum number of prototypes when a new sample is added.
+            :param model_object: JSON representation of the object
+            :type model_object: dict
+            :return: Whether this object is a valid representation or not
+            :rtype: bool
+        """
+        valid = super().load(model_object)
+        self._mean = None
+        if isinstance(self._data, dict) and self._data.get('mean') is not None:
+            self._mean = decode_features(self._data['mean'], self._data['dtype'])[0]
+        return valid
+
+    def to_json(self):
+        """
+            Get a JSON representation of the object, with the prototypes as samples
+            :return: JSON representation
+            :rtype: dict
+        """
+        model = super().to_json()
+        mean = self.get_mean()
+        model['data']['mode'] = 'prototypes'
+        model['data']['mean'] = None if mean is None else encode_features(mean, self._encodings_dtype)
+        return model
 
-            :return: list
+    def get_mean(self):
         """
-        encodings = []
-        for sample in self._samples:
-            encodings.append(np.array(sample['features']))
-        return encodings
+            Get the mean of all the encodings added to the model
+            :return: Mean encoding or None if the model is empty
+            :rtype: np.ndarray
+        """
+        if self._mean is None and len(self._samples) > 0:
+            self._mean = self.get_encodings().mean(axis=0)
+        return self._mean
+
+    def add_sample(self, sample, features=None):
+        """
+            Add given sample to model, update the running mean and the enrolment percentage, and keep only the
+            most representative prototypes
+            :param sample: Sample object
+            :type sample: tesla_ce_provider.models.base.Sample
+            :param features: Optional provider representation for this sample
+            :type features: dict
+        """
+        encoding = np.asarray(features[0], dtype=np.float32).reshape(ENCODING_SIZE)
+        mean = self.get_mean()
+        if mean is None:
+            self._mean = encoding.copy()
+        else:
+            self._mean = mean + (encoding - mean) / float(self._num_samples + 1)
+        super().add_sample(sample, features)
+        self._reduce_prototypes()
+
+    def _reduce_prototypes(self):
+        """
+            Remove prototypes until the maximum number is reached. From the closest pair of prototypes, the one
+            farther from the mean is removed, keeping the references spread and discarding outliers first.
+        """
+        encodings = self.get_encodings()
+        while encodings.shape[0] > self._max_prototypes:
+            distances = self._norms[:, np.newaxis] + self._norms[np.newaxis, :] - 2.0 * np.dot(encodings, encodings.T)
+            np.fill_diagonal(distances, np.inf)
+            pair = np.unravel_index(int(np.argmin(distances)), distances.shape)
+            mean_distances = np.sum((encodings[list(pair)] - self._mean) ** 2, axis=1)
+            remove = int(pair[int(np.argmax(mean_distances))])
+            # Samples list is rebuilt, as it can be shared with the loaded model object
+            self._samples = [sample for idx, sample in enumerate(self._samples) if idx != remove]
+            encodings = np.delete(encodings, remove, axis=0)
+            self._set_encodings(encodings)
+
+
+def get_model_mode(model_object):
+    """
+        Get the mode of a serialized model
+
+        :param model_object: JSON representation of the model
+        :type model_object: dict
+        :return: 'prototypes' for models with a bounded set of prototypes, or 'samples' otherwise
+        :rtype: str
+    """
+    if model_object is not None and isinstance(model_object.get('data'), dict):
+        return model_object['data'].get('mode', 'samples')
+    return 'samples'
@@ -13,14 +13,30 @@
 #      You should have received a copy of the GNU Affero General Public License
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ TeSLA CE Face Recognition module """
-import face_recognition
-import simplejson
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 import numpy as np
 from tesla_ce_provider import BaseProvider, result, message
 from tesla_ce_provider.models.fr import FRValidationData
 from tesla_ce_provider.provider.audit.fr import FaceRecognitionAudit
 from . import utils
-from .models import FRSimpleModel
+from .cache import LRUCache
+from .message import TFRMessage
+from .models import FRSimpleModel, FRPrototypeModel, get_model_key, get_model_mode, encode_features, \
+    decode_features, SEARCH_BLOCK_SIZE
+from .timing import NULL_TIMER, StageTimer, instrumented
+
+# Face detection and encoding models are loaded on first use
+face_recognition = utils.lazy_import('face_recognition')
+
+#: Identifier of the last process where the provider was warmed up
+_warm_up_pid = None
+
+#: Image with a face used to warm up the models
+WARM_UP_IMAGE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data',
+                                  'face_sample.b64')
 
 
 class TFRProvider(BaseProvider):
@@ -29,6 +45,61 @@ class TFRProvider(BaseProvider):
     """
     _logger = None
 
+    #: Maximum number of sessions with a tracked face region
+    ROI_TRACKER_SIZE = 4096
+
+    #: Time in seconds a tracked face region is kept without new requests in the session
+    ROI_TRACKER_TTL = 600
+
+    #: Score thresholds used when they are not available in provider information
+    DEFAULT_ALERT_BELOW = 0.3
+    DEFAULT_WARNING_BELOW = 0.6
+
+    #: Provider options, as the configuration key and the function converting the value of each option
+    OPTIONS = {
+        'model': ('model', str),
+        'cascade_min_face_size': ('cascade_min_face_size', float),
+        'fast_validation': ('fast_validation', bool),
+        'upsample_times': ('number_of_times_to_upsample', int),
+        'min_enrol_samples': ('min_enrol_samples', int),
+        'target_enrol_samples': ('target_enrol_samples', int),
+        'encoding_num_jitters': ('encoding_num_jitters', int),
+        'model_encoding_dtype': ('model_encoding_dtype', str),
+        'model_cache_size': ('model_cache_size', int),
+        'model_cache_ttl': ('model_cache_ttl', float),
+        'frame_cache_size': ('frame_cache_size', int),
+        'frame_cache_ttl': ('frame_cache_ttl', float),
+        'detection_batch_size': ('detection_batch_size', int),
+        'detection_max_side': ('detection_max_side', int),
+        'detection_refine': ('detection_refine', bool),
+        'roi_tracking': ('roi_tracking', bool),
+        'roi_margin': ('roi_margin', float),
+        'roi_full_frame_interval': ('roi_full_frame_interval', int),
+        'verification_jitter_policy': ('verification_jitter_policy', str),
+        'adaptive_jitter_band': ('adaptive_jitter_band', float),
+        'instrumentation': ('instrumentation', bool),
+        'max_working_resolution': ('max_working_resolution', int),
+        'quality_gate': ('quality_gate', str),
+        'quality_min_sharpness': ('quality_min_sharpness', float),
+        'quality_min_contrast': ('quality_min_contrast', float),
+        'quality_min_brightness': ('quality_min_brightness', float),
+        'quality_max_brightness': ('quality_max_brightness', float),
+        'audit_images': ('audit_images', str),
+        'audit_image_quality': ('audit_image_quality', int),
+        'audit_image_max_side': ('audit_image_max_side', int),
+        'validation_encodings': ('validation_encodings', bool),
+        'model_mode': ('model_mode', str),
+        'model_max_prototypes': ('model_max_prototypes', int),
+        'enrol_duplicate_policy': ('enrol_duplicate_policy', str),
+        'enrol_duplicate_distance': ('enrol_duplicate_distance', float),
+        'verification_deadline': ('verification_deadline', float),
+        'deadline_margin': ('deadline_margin', float),
+        'early_exit_distance': ('early_exit_distance', float),
+        'search_block_size': ('search_block_size', int),
+        'compute_threads': ('compute_threads', int),
+        'enrol_workers': ('enrol_workers', int)
+    }
+
     def __init__(self):
         super().__init__()
         self._model_class = FRSimpleModel
@@ -37,12 +108,71 @@ class TFRProvider(BaseProvider):
         self.accepted_mimetypes = self._video_mimetypes + self._image_mimetypes
         self.config = {
             'model': 'cnn',
+            'cascade_min_face_size': 0.3,
             'fast_validation': False,
             'number_of_times_to_upsample': 1,
             'min_enrol_samples': 10,
             'target_enrol_samples': 15,
-            'encoding_num_jitters': 5
+            'encoding_num_jitters': 5,
+            'model_encoding_dtype': 'float32',
+            'model_cache_size': 256,
+            'model_cache_ttl': 900,
+            'frame_cache_size': 0,
+            'frame_cache_ttl': 300,
+            'detection_batch_size': 32,
+            'enrol_workers': 1,
+            'detection_max_side': 0,
+            'detection_refine': False,
+            'roi_tracking': False,
+            'roi_margin': 0.75,
+            'roi_full_frame_interval': 10,
+            'verification_jitter_policy': 'fixed',
+            'adaptive_jitter_band': 0.05,
+            'instrumentation': False,
+            'max_working_resolution': 0,
+            'quality_gate': 'off',
+            'quality_min_sharpness': 50,
+            'quality_min_contrast': 20,
+            'quality_min_brightness': 20,
+            'quality_max_brightness': 235,
+            'audit_images': 'always',
+            'audit_image_quality': 75,
+            'audit_image_max_side': 0,
+            'validation_encodings': False,
+            'model_mode': 'samples',
+            'model_max_prototypes': 16,
+            'enrol_duplicate_policy': 'keep',
+            'enrol_duplicate_distance': 0.1,
+            'compute_threads': 0,
+            'verification_deadline': 0,
+            'deadline_margin': 1.0,
+            'early_exit_distance': 0,
+            'search_block_size': SEARCH_BLOCK_SIZE
         }
+        if os.getenv('TFR_COMPUTE_THREADS') is not None:
+            self.config['compute_threads'] = int(os.getenv('TFR_COMPUTE_THREADS'))
+        self._model_cache = LRUCache(self.config['model_cache_size'], self.config['model_cache_ttl'])
+        self._frame_cache = LRUCache(self.config['frame_cache_size'], self.config['frame_cache_ttl'])
+        self._roi_tracker = LRUCache(self.ROI_TRACKER_SIZE, self.ROI_TRACKER_TTL)
+
+        #: Timer for the current operation
+        self._timer = NULL_TIMER
+
+        #: Function receiving the stage timings of each operation
+        self._timing_hook = None
+
+        #: Stage timings of the last instrumented operation
+        self.last_timings = None
+
+        #: Time (as returned by time.time) when the result of current request is due, if it has a deadline
+        self._deadline = None
+
+        #: Stages of current request processed with cheaper settings to meet the deadline
+        self._degraded_stages = []
+
+        #: Effective number of threads of each compute thread pool, if limited
+        self.compute_threads = None
+        self._set_compute_threads()
 
     def set_options(self, options):
         """
@@ -50,20 +180,169 @@ class TFRProvider(BaseProvider):
             :param options: Provider options following provider options_scheme definition
             :type options: dict
         """
-        if options is not None:
-            if 'model' in options:
-                self.config['model'] = options['model']
-            if 'fast_validation' in options:
-                self.config['fast_validation'] = options['fast_validation']
-            if 'upsample_times' in options:
-                self.config['number_of_times_to_upsample'] = options['upsample_times']
-            if 'min_enrol_samples' in options:
-                self.config['min_enrol_samples'] = options['min_enrol_samples']
-            if 'target_enrol_samples' in options:
-                self.config['target_enrol_samples'] = options['target_enrol_samples']
-            if 'encoding_num_jitters' in options:
-                self.config['encoding_num_jitters'] = options['encoding_num_jitters']
+        if options is None:
+            return
+        compute_threads = self.config['compute_threads']
+        for name, (key, cast) in self.OPTIONS.items():
+            if name in options:
+                self.config[key] = cast(options[name])
+        if self.config['compute_threads'] != compute_threads:
+            self._set_compute_threads()
+        self._model_cache.configure(self.config['model_cache_size'], self.config['model_cache_ttl'])
+        self._frame_cache.configure(self.config['frame_cache_size'], self.config['frame_cache_ttl'])
+
+    def _set_compute_threads(self):
+        """
+            Limit the number of threads used by numpy BLAS and dlib in current process, if configured
+        """
+        if self.config['compute_threads'] <= 0:
+            return
+        self.compute_threads = utils.set_compute_threads(self.config['compute_threads'])
+        self._log_compute_threads()
+
+    def _log_compute_threads(self):
+        """
+            Report the effective number of threads of each compute thread pool, if limited
+        """
+        if self.compute_threads is None:
+            return
+        self.log_trace('TFR: Compute threads limited to {}: [{}]'.format(self.config['compute_threads'], ', '.join(
+            '{}={}'.format(pool, num_threads) for pool, num_threads in self.compute_threads.items())))
+
+    def set_logger(self, logger):
+        """
+            Set a logging function. Compute thread limits applied before, i.e. from the TFR_COMPUTE_THREADS
+            environment variable when the provider is created, are reported to the new logger.
+            :param logger: Logging function that accepts a message as argument
+        """
+        super().set_logger(logger)
+        self._log_compute_threads()
 
+    def get_cache_stats(self):
+        """
+            Get the statistics of the provider caches
+            :return: Statistics for each cache
+            :rtype: dict
+        """
+        return {
+            'models': self._model_cache.stats(),
+            'frames': self._frame_cache.stats()
+        }
+
+    def set_timing_hook(self, hook):
+        """
+            Set a function receiving the stage timings of each instrumented operation
+            :param hook: Function accepting the operation name and a dictionary with the time of each stage in ms
+        """
+        self._timing_hook = hook
+
+    def start_timer(self, operation):
+        """
+            Start measuring the stages of an operation
+            :param operation: Operation name
+            :type operation: str
+        """
+        self._timer = StageTimer(operation)
+
+    def finish_timer(self):
+        """
+            Finish measuring current operation, reporting the stage timings
+        """
+        timer = self._timer
+        self._timer = NULL_TIMER
+        if not timer.enabled:
+            return
+        self.last_timings = timer.get_timings()
+        self.log_trace('TFR: Timings for {}: [{}]'.format(timer.operation, ', '.join(
+            '{}={:.2f}ms'.format(stage, duration) for stage, duration in self.last_timings.items())))
+        if self._timing_hook is not None:
+            self._timing_hook(timer.operation, self.last_timings)
+
+    def warm_up(self, force=False):
+        """
+            Load the face detection and encoding models and run them once on a bundled image, so the first request
+            does not pay the initialization costs. It is intended to be called once in each worker process, after
+            forking. Next calls in the same process do nothing.
+            :param force: Run the warm-up even if it was already done in current process
+            :type force: bool
+            :return: Time in seconds spent in the warm-up, or None if it was already done
+            :rtype: float
+        """
+        global _warm_up_pid
+        if not force and _warm_up_pid == os.getpid():
+            return None
+        start = time.perf_counter()
+        with open(WARM_UP_IMAGE_PATH, 'r') as fd_image:
+            image, _ = utils.decode_sample_image(SimpleNamespace(data=fd_image.read().strip()),
+                                                 self.config['max_working_resolution'])
+        face_locations = self._find_faces(image)
+        face_recognition.face_encodings(image, face_locations[:1], num_jitters=1)
+        _warm_up_pid = os.getpid()
+        elapsed = time.perf_counter() - start
+        self.log_trace('TFR: Warm-up finished in {:.2f}s: [model={}, faces={}, threads={}]'.format(
+            elapsed, self.config['model'], len(face_locations), utils.get_compute_threads()))
+        return elapsed
+
+    def _load_model(self, learner_id, model):
+        """
+            Load a learner model. Loaded models are kept in a cache, so the same model is not decoded again
+            :param learner_id: Learner unique identifier
+            :type learner_id: str
+            :param model: Provider model
+            :type model: dict
+            :return: Loaded model
+            :rtype: FRSimpleModel
+        """
+        model_key = get_model_key(model) if self._model_cache.enabled else None
+        if model_key is None:
+            return self._model_class(model)
+        key = (learner_id, model_key)
+        tfr_model = self._model_cache.get(key)
+        if tfr_model is None:
+            self.log_trace('TFR: Model not found in cache.')
+            tfr_model = self._model_class(model)
+            # Build the encodings matrix before storing the model
+            tfr_model.get_encodings()
+            self._model_cache.put(key, tfr_model)
+        return tfr_model
+
+    def _check_quality(self, image):
+        """
+            Check the quality of an image before looking for faces, if the quality gate is enabled
+            :param image: Image
+            :type image: np.array
+            :return: Error message if the image does not pass the quality gate or None otherwise
+            :rtype: str
+        """
+        if self.config['quality_gate'] == 'off':
+            return None
+        with self._timer.stage('quality_check'):
+            quality_check = utils.check_image_quality(image,
+                                                      min_sharpness=self.config['quality_min_sharpness'],
+                                                      min_contrast=self.config['quality_min_contrast'],
+                                                      min_brightness=self.config['quality_min_brightness'],
+                                                      max_brightness=self.config['quality_max_brightness'])
+        if not quality_check['valid']:
+            self.log_trace('TFR: Low quality image: {} [{}]'.format(quality_check['msg'], ', '.join(
+                '{}={:.1f}'.format(key, value) for key, value in quality_check['quality'].items())))
+        return quality_check['msg']
+
+    def _create_enrolment_model(self, model):
+        """
+            Create the model updated in an enrolment. Models created with a bounded set of prototypes keep using
+            prototypes, even if the configured mode changes, as their discarded samples cannot be recovered.
+            :param model: Current model
+            :type model: dict
+            :return: Loaded model
+            :rtype: FRSimpleModel
+        """
+        if self.config['model_mode'] != 'prototypes' and get_model_mode(model) != 'prototypes':
+            return self._model_class(model)
+        tfr_model = FRPrototypeModel(model)
+        tfr_model.set_max_prototypes(self.config['model_max_prototypes'])
+        return tfr_model
+
+    @instrumented('enrol')
     def enrol(self, samples, model=None):
         """
             Update the model with a new enrolment sample
@@ -76,73 +355,182 @@ class TFRProvider(BaseProvider):
         """
         # Load model
         self.log_trace('TFR: Start enrolment process.')
-        tfr_model = self._model_class(model)
+        with self._timer.stage('model'):
+            tfr_model = self._create_enrolment_model(model)
         tfr_model.set_required_samples(self.config['target_enrol_samples'])
         tfr_model.set_min_required_samples(self.config['min_enrol_samples'])
+        tfr_model.set_encodings_dtype(self.config['model_encoding_dtype'])
+        tfr_model.set_duplicate_policy(self.config['enrol_duplicate_policy'], self.config['enrol_duplicate_distance'])
 
         self.log_trace('TFR: Start processing enrolment samples')
-        for sample in samples:
-            self.log_trace('TFR: Sample process START')
-            # Get the image
-            image = utils.get_sample_image(sample)
-            if image is None:
-                self.log_trace('TFR: Image is None. Skip enrolment for current sample: \n{}'.format(
-                    simplejson.dumps(sample, indent=4, skipkeys=True))
-                )
+        for sample, (valid, error_message, encoding) in zip(samples, self._process_enrolment_samples(samples)):
+            if not valid:
+                self.log_trace('TFR: Invalid sample. Brake enrolment process.')
+                return result.EnrolmentResult(tfr_model.to_json(),
+                                              tfr_model.get_percentage(),
+                                              tfr_model.can_analyse(),
+                                              valid=False,
+                                              error_message=error_message)
+            if encoding is None:
+                self.log_trace('TFR: Image is None. Skip enrolment for sample {}.'.format(sample.sample_id))
                 continue
-
-            # Get face locations
-            face_locations = None
-            if not self.config['fast_validation']:
-                self.log_trace('TFR: Search for matching validation data.')
-                # If fast validation is disabled, information obtained in the validation can be used.
-                for validation in sample.validations:
-                    if validation.provider['id'] == self.provider_id:
-                        self.log_trace('Validation data is available. Using validated information.')
-                        face_locations = [(
-                            # top
-                            validation.face_location['top'],
-                            # right
-                            validation.face_location['left'] + validation.face_location['width'] - 1,
-                            # bottom
-                            validation.face_location['top'] + validation.face_location['height'] - 1,
-                            # left
-                            validation.face_location['left'],
-                        ),]
-            if face_locations is None:
-                self.log_trace('TFR: Validation data is not available. Find faces in image.')
-                face_locations = face_recognition.face_locations(
-                    image,
-                    number_of_times_to_upsample=self.config['number_of_times_to_upsample'],
-                    model=self.config['model']
-                )
-                if len(face_locations) == 0:
-                    self.log_trace('TFR: No faces in image. Brake enrolment process.')
-                    return result.EnrolmentResult(tfr_model.to_json(),
-                                                  tfr_model.get_percentage(),
-                                                  tfr_model.can_analyse(),
-                                                  valid=False,
-                                                  error_message=message.Provider.PROVIDER_INVALID_SAMPLE_DATA.value)
-                if len(face_locations) > 1:
-                    self.log_trace('TFR: Multiple faces in image. Brake enrolment process.')
-                    return result.EnrolmentResult(tfr_model.to_json(),
-                                                  tfr_model.get_percentage(),
-                                                  tfr_model.can_analyse(),
-                                                  valid=False,
-                                                  error_message=message.Provider.PROVIDER_MULTIPLE_PEOPLE.value)
-
-            # Get face descriptor
-            self.log_trace('TFR: One face detected. Compute encodings.')
-            encoding = face_recognition.face_encodings(image,
-                                                       face_locations,
-                                                       num_jitters=self.config['encoding_num_jitters'])
             self.log_trace('TFR: Add encodings to model.')
             tfr_model.add_sample(sample, encoding)
-            self.log_trace('TFR: Sample process END')
         self.log_trace('TFR: Enrolment process finished: [percentage={}]'.format(tfr_model.get_percentage()))
         return result.EnrolmentResult(tfr_model.to_json(), tfr_model.get_percentage(), tfr_model.can_analyse(),
                                       used_samples=tfr_model.get_used_samples())
 
+    def _process_enrolment_samples(self, samples):
+        """
+            Process a list of enrolment samples, using a pool of threads if parallel enrolment is enabled. Face
+            detection and encoding release the GIL, and threads can be used in Celery prefork workers, where daemonic
+            processes cannot create child processes.
+            :param samples: Enrolment samples
+            :type samples: list
+            :return: Generator with the processing result for each sample, in the same order
+        """
+        validation_data = [self._get_validation_data(sample) for sample in samples]
+        num_pending = sum(1 for _, encoding in validation_data if encoding is None)
+        if self.config['enrol_workers'] <= 1 or num_pending <= 1:
+            for sample, (locations, encoding) in zip(samples, validation_data):
+                if encoding is not None:
+                    yield True, None, [encoding]
+                else:
+                    yield self._process_enrolment_sample(sample, locations)
+            return
+
+        self.log_trace('TFR: Processing {} samples in parallel.'.format(num_pending))
+        # dlib models cannot be shared by threads running at the same time
+        utils.set_thread_safe_models(face_recognition)
+        with ThreadPoolExecutor(max_workers=self.config['enrol_workers']) as pool:
+            # Samples with validated encodings are not sent to the pool
+            futures = [None if encoding is not None else pool.submit(self._process_enrolment_sample, sample, locations)
+                       for sample, (locations, encoding) in zip(samples, validation_data)]
+            try:
+                for idx, future in enumerate(futures):
+                    if future is None:
+                        yield True, None, [validation_data[idx][1]]
+                        continue
+                    sample_result = future.result()
+                    yield sample_result
+                    if not sample_result[0]:
+                        return
+            finally:
+                # Samples after an invalid one are not processed
+                for future in futures:
+                    if future is not None:
+                        future.cancel()
+
+    def _get_detection_key(self):
+        """
+            Get the values of all the options that affect the detected faces
+            :return: Detection configuration
+            :rtype: tuple
+        """
+        return (self.config['model'], self.config['number_of_times_to_upsample'],
+                self.config['cascade_min_face_size'], self.config['detection_max_side'],
+                self.config['detection_refine'], self.config['max_working_resolution'], self.config['roi_tracking'],
+                self.config['roi_margin'], self.config['roi_full_frame_interval'])
+
+    def _get_encoding_key(self):
+        """
+            Get a key identifying the provider version and the configuration used to compute enrolment encodings.
+            Encodings stored in validation data are only reused if they were computed with the same key.
+            :return: Encoding configuration key
+            :rtype: str
+        """
+        info = self.info or {}
+        return ':'.join(str(value) for value in (info.get('version'), ) + self._get_detection_key() + (
+            self.config['encoding_num_jitters'], ))
+
+    def _get_validation_data(self, sample):
+        """
+            Get the face location and the face encoding obtained in the validation of an enrolment sample
+            :param sample: Enrolment sample
+            :type sample: tesla_ce_provider.models.base.Sample
+            :return: Face location and face encoding. Each value is None if it is not available in validation data
+            :rtype: tuple
+        """
+        face_locations = None
+        encoding = None
+        if not self.config['fast_validation'] and sample.validations is not None:
+            self.log_trace('TFR: Search for matching validation data.')
+            # If fast validation is disabled, information obtained in the validation can be used.
+            for validation in sample.validations:
+                if validation.provider['id'] == self.provider_id:
+                    self.log_trace('Validation data is available. Using validated information.')
+                    encoding = self._get_validated_encoding(validation)
+                    face_locations = [(
+                        # top
+                        validation.face_location['top'],
+                        # right
+                        validation.face_location['left'] + validation.face_location['width'] - 1,
+                        # bottom
+                        validation.face_location['top'] + validation.face_location['height'] - 1,
+                        # left
+                        validation.face_location['left'],
+                    ),]
+        return face_locations, encoding
+
+    def _get_validated_encoding(self, validation):
+        """
+            Get the face encoding stored in the validation data of an enrolment sample
+            :param validation: Validation data
+            :type validation: tesla_ce_provider.models.fr.FRValidationData
+            :return: Face encoding or None if it is not available or was computed with a different configuration
+            :rtype: np.array
+        """
+        info = getattr(validation, 'info', None)
+        if not isinstance(info, dict) or 'encoding' not in info:
+            return None
+        if info.get('encoding_key') != self._get_encoding_key():
+            self.log_trace('TFR: Validated encoding computed with a different configuration. Ignoring it.')
+            return None
+        self.log_trace('TFR: Using validated encoding.')
+        return decode_features(info['encoding'], info.get('encoding_dtype', 'float32'))[0]
+
+    def _process_enrolment_sample(self, sample, face_locations=None):
+        """
+            Compute the face encoding of an enrolment sample
+            :param sample: Enrolment sample
+            :type sample: tesla_ce_provider.models.base.Sample
+            :param face_locations: Face location from validation data
+            :type face_locations: list
+            :return: Tuple with the validity of the sample, the error message and the face encoding. If the sample
+                     image cannot be read, the sample is valid but the encoding is None.
+            :rtype: tuple
+        """
+        # Get the image
+        with self._timer.stage('decode'):
+            image, scale = utils.decode_sample_image(sample, self.config['max_working_resolution'])
+        if image is None:
+            return True, None, None
+        if face_locations is not None and scale != 1.0:
+            # Validated locations refer to the original image
+            face_locations = [utils.scale_face_location(location, 1.0 / scale, image.shape)
+                              for location in face_locations]
+
+        # Get face locations
+        if face_locations is None:
+            self.log_trace('TFR: Validation data is not available. Find faces in image.')
+            with self._timer.stage('detection'):
+                face_locations = self._find_faces(image)
+            if len(face_locations) == 0:
+                self.log_trace('TFR: No faces in image.')
+                return False, message.Provider.PROVIDER_INVALID_SAMPLE_DATA.value, None
+            if len(face_locations) > 1:
+                self.log_trace('TFR: Multiple faces in image.')
+                return False, message.Provider.PROVIDER_MULTIPLE_PEOPLE.value, None
+
+        # Get face descriptor
+        self.log_trace('TFR: One face detected. Compute encodings.')
+        with self._timer.stage('encoding'):
+            encoding = face_recognition.face_encodings(image,
+                                                       face_locations,
+                                                       num_jitters=self.config['encoding_num_jitters'])
+        return True, None, encoding
+
+    @instrumented('validate_sample')
     def validate_sample(self, sample, validation_id):
         """
             Validate an enrolment sample
@@ -154,7 +542,9 @@ class TFRProvider(BaseProvider):
             :rtype: tesla_ce_provider.ValidationResult
         """
         # Check provided input
-        sample_check = utils.check_sample_image(sample, self.accepted_mimetypes)
+        with self._timer.stage('decode'):
+            sample_check = utils.check_sample_image(sample, self.accepted_mimetypes,
+                                                    self.config['max_working_resolution'])
         if not sample_check['valid']:
             return result.ValidationResult(False, sample_check['msg'],
                                            message_code_id=sample_check['code'])
@@ -162,23 +552,27 @@ class TFRProvider(BaseProvider):
         # mimetype = sample_check['mimetype']
         image = sample_check['image']
 
-        if utils.is_black_image(image):
+        with self._timer.stage('black_check'):
+            is_black = utils.is_black_image(image)
+        if is_black:
             return result.ValidationResult(False, "Black image.",
                                            message_code_id=message.Provider.PROVIDER_BLACK_IMAGE.value)
 
+        quality_error = self._check_quality(image)
+        if quality_error is not None and self.config['quality_gate'] == 'reject':
+            return result.ValidationResult(False, quality_error,
+                                           message_code_id=TFRMessage.PROVIDER_LOW_QUALITY_IMAGE.value)
+
         # Detect faces (top, right, bottom, left)
-        if self.config['fast_validation']:
-            face_locations = face_recognition.face_locations(
-                image,
-                number_of_times_to_upsample=0,
-                model="hog"
-            )
-        else:
-            face_locations = face_recognition.face_locations(
-                image,
-                number_of_times_to_upsample=self.config['number_of_times_to_upsample'],
-                model=self.config['model']
-            )
+        with self._timer.stage('detection'):
+            if self.config['fast_validation']:
+                face_locations = face_recognition.face_locations(
+                    image,
+                    number_of_times_to_upsample=0,
+                    model="hog"
+                )
+            else:
+                face_locations = self._find_faces(image)
 
         if len(face_locations) == 0:
             return result.ValidationResult(False, "No faces in image.",
@@ -187,79 +581,515 @@ class TFRProvider(BaseProvider):
             return result.ValidationResult(False, "Multiple faces in the image.",
                                            message_code_id=message.Provider.PROVIDER_MULTIPLE_PEOPLE.value)
 
+        # Report the location in the original image
+        top, right, bottom, left = utils.scale_face_location(face_locations[0], sample_check['scale'])
+
+        validation_info = {}
+        if quality_error is not None:
+            validation_info['warnings'] = [TFRMessage.PROVIDER_LOW_QUALITY_IMAGE.value]
+        if self.config['validation_encodings'] and not self.config['fast_validation']:
+            # Store the encoding, so it is not computed again in the enrolment
+            with self._timer.stage('encoding'):
+                encoding = face_recognition.face_encodings(image, face_locations,
+                                                           num_jitters=self.config['encoding_num_jitters'])[0]
+            validation_info['encoding'] = encode_features(encoding, self.config['model_encoding_dtype'])
+            validation_info['encoding_dtype'] = self.config['model_encoding_dtype']
+            validation_info['encoding_key'] = self._get_encoding_key()
+
         face = FRValidationData()
         face.set_instrument(self.instrument['id'], self.instrument['acronym'])
         face.set_provider(self.provider_id, self.info['acronym'], self.info['version'])
-        face.set_location(face_locations[0][3],
-                          face_locations[0][0],
-                          face_locations[0][2] - face_locations[0][0] + 1,
-                          face_locations[0][1] - face_locations[0][3] + 1)
+        face.set_location(left, top, bottom - top + 1, right - left + 1)
+        if len(validation_info) > 0:
+            face.set_info(validation_info)
 
         return result.ValidationResult(True,
                                        contribution=1.0 / float(self.config['target_enrol_samples']),
                                        info=face.to_json())
 
-    def verify(self, request, model):
+    def _detect_faces(self, image, number_of_times_to_upsample=None):
         """
-            Verify a learner request
+            Run the face detector on an image
+            :param image: Image
+            :type image: np.array
+            :param number_of_times_to_upsample: Number of upsampling steps. If not provided, configured value is used
+            :type number_of_times_to_upsample: int
+            :return: List of face locations as (top, right, bottom, left)
+            :rtype: list
+        """
+        if number_of_times_to_upsample is None:
+            number_of_times_to_upsample = self.config['number_of_times_to_upsample']
+        model = self.config['model']
+        if model == 'cascade':
+            face_locations = self._detect_cascade_faces(image)
+            if face_locations is not None:
+                return face_locations
+            model = 'cnn'
+        return face_recognition.face_locations(
+            image,
+            number_of_times_to_upsample=number_of_times_to_upsample,
+            model=model
+        )
+
+    def _detect_cascade_faces(self, image):
+        """
+            First step of the cascade detector, using the hog detector without upsampling
+            :param image: Image
+            :type image: np.array
+            :return: List of face locations, or None if the result is ambiguous and the cnn detector must be used
+            :rtype: list
+        """
+        face_locations = face_recognition.face_locations(image, number_of_times_to_upsample=0, model='hog')
+        if len(face_locations) != 1:
+            self.log_trace('TFR: {} faces found with hog detector. Using cnn detector.'.format(len(face_locations)))
+            return None
+        # A single small face usually means the learner is far from the camera, and other people in the frame
+        # may be missed by hog (tilted or partially visible faces). Check them with cnn.
+        top, right, bottom, left = face_locations[0]
+        face_size = min(bottom - top, right - left) / min(image.shape[:2])
+        if face_size < self.config['cascade_min_face_size']:
+            self.log_trace('TFR: Small face found with hog detector ({:.2f}). Using cnn detector.'.format(face_size))
+            return None
+        return face_locations
+
+    def _get_detection_image(self, image):
+        """
+            Get the image used for face detection. If coarse detection is enabled, a reduced version is returned.
+            :param image: Image
+            :type image: np.array
+            :return: Detection image and the scale factor to the original image
+            :rtype: tuple
+        """
+        if self.config['detection_max_side'] > 0:
+            return utils.resize_image(image, self.config['detection_max_side'])
+        return image, 1.0
+
+    def _restore_face_locations(self, image, face_locations, scale):
+        """
+            Map face locations found in a reduced image back to the original image
+            :param image: Original image
+            :type image: np.array
+            :param face_locations: List of face locations in the reduced image
+            :type face_locations: list
+            :param scale: Scale factor from reduced to original image
+            :type scale: float
+            :return: List of face locations in the original image
+            :rtype: list
+        """
+        if scale == 1.0:
+            return face_locations
+        face_locations = [utils.scale_face_location(location, scale, image.shape) for location in face_locations]
+        if self.config['detection_refine']:
+            face_locations = [self._refine_face_location(image, location) for location in face_locations]
+        return face_locations
+
+    def _refine_face_location(self, image, face_location):
+        """
+            Refine a face location by running the detector on the full resolution region around the face
+            :param image: Original image
+            :type image: np.array
+            :param face_location: Approximated face location
+            :type face_location: tuple
+            :return: Refined face location, or the approximated one if the face is not found in the region
+            :rtype: tuple
+        """
+        top, right, bottom, left = utils.expand_face_location(face_location, 0.5, image.shape)
+        region = np.ascontiguousarray(image[top:bottom, left:right])
+        region_locations = self._detect_faces(region, number_of_times_to_upsample=0)
+        if len(region_locations) != 1:
+            return face_location
+        return (region_locations[0][0] + top, region_locations[0][1] + left,
+                region_locations[0][2] + top, region_locations[0][3] + left)
+
+    def _find_faces(self, image):
+        """
+            Find the faces in an image using current detection configuration
+            :param image: Image
+            :type image: np.array
+            :return: List of face locations as (top, right, bottom, left)
+            :rtype: list
+        """
+        detection_image, scale = self._get_detection_image(image)
+        return self._restore_face_locations(image, self._detect_faces(detection_image), scale)
+
+    def _find_session_faces(self, image, session_key):
+        """
+            Find the faces in an image of an assessment session. If a face was found in the previous frame of the
+            session, faces are searched only in the region around it, falling back to the full image if no face is
+            found there. The full image is also analysed periodically, to detect other people in the frame.
+            :param image: Image
+            :type image: np.array
+            :param session_key: Session identifier as (learner_id, session_id)
+            :type session_key: tuple
+            :return: List of face locations as (top, right, bottom, left)
+            :rtype: list
+        """
+        face_locations = None
+        num_frames = 0
+        state = self._roi_tracker.get(session_key)
+        interval = self.config['roi_full_frame_interval']
+        if state is not None and state['shape'] == image.shape and (interval <= 0 or state['frames'] < interval):
+            top, right, bottom, left = utils.expand_face_location(state['location'], self.config['roi_margin'],
+                                                                  image.shape)
+            region_locations = self._find_faces(np.ascontiguousarray(image[top:bottom, left:right]))
+            if len(region_locations) > 0:
+                self.log_trace('TFR: Face found in the tracked region.')
+                face_locations = [(location[0] + top, location[1] + left, location[2] + top, location[3] + left)
+                                  for location in region_locations]
+                num_frames = state['frames'] + 1
+        if face_locations is None:
+            face_locations = self._find_faces(image)
+
+        # Track the region only when a single face is found
+        if len(face_locations) == 1:
+            self._roi_tracker.put(session_key, {
+                'location': face_locations[0],
+                'shape': image.shape,
+                'frames': num_frames
+            })
+        else:
+            self._roi_tracker.pop(session_key)
+        return face_locations
+
+    def _find_faces_batch(self, images):
+        """
+            Find the faces in a list of images using current detection configuration. Images with the same size
+            are processed together when the cnn detector is used, either directly or as second step of the cascade.
+            :param images: List of images
+            :type images: list
+            :return: List of face locations for each image
+            :rtype: list
+        """
+        face_locations = [None] * len(images)
+        if self.config['model'] == 'hog':
+            for idx, image in enumerate(images):
+                face_locations[idx] = self._find_faces(image)
+            return face_locations
+
+        detection_images = [self._get_detection_image(image) for image in images]
+        pending = range(len(images))
+        if self.config['model'] == 'cascade':
+            # Only images with ambiguous results in the first step of the cascade are processed with cnn
+            pending = []
+            for idx, (detection_image, scale) in enumerate(detection_images):
+                locations = self._detect_cascade_faces(detection_image)
+                if locations is None:
+                    pending.append(idx)
+                else:
+                    face_locations[idx] = self._restore_face_locations(images[idx], locations, scale)
+
+        # Group images by size, as the batched detector requires images with the same shape
+        groups = {}
+        for idx in pending:
+            groups.setdefault(detection_images[idx][0].shape, []).append(idx)
+        for indexes in groups.values():
+            batch_locations = face_recognition.batch_face_locations(
+                [detection_images[idx][0] for idx in indexes],
+                number_of_times_to_upsample=self.config['number_of_times_to_upsample'],
+                batch_size=self.config['detection_batch_size']
+            )
+            for idx, locations in zip(indexes, batch_locations):
+                face_locations[idx] = self._restore_face_locations(images[idx], locations, detection_images[idx][1])
+        return face_locations
+
+    def _get_verification_image(self, request):
+        """
+            Get the image for a verification request
             :param request: Verification request
             :type request: tesla_ce_provider.models.base.Request
-            :param model: Provider model
-            :type model: dict
-            :return: Verification result
-            :rtype: tesla_ce_provider.VerificationResult
+            :return: The image, the scale factor to the original image and the list of warnings, or the verification
+                     result if the request cannot be verified
+            :rtype: tuple
         """
-        # Load model
-        tfr_model = self._model_class(model)
-
         # Check provided input
-        sample_check = utils.check_sample_image(request, self.accepted_mimetypes)
+        with self._timer.stage('decode'):
+            sample_check = utils.check_sample_image(request, self.accepted_mimetypes,
+                                                    self.config['max_working_resolution'])
         if not sample_check['valid']:
-            return result.VerificationResult(True, error_message=sample_check['msg'],
-                                             message_code=sample_check['code'])
+            return None, None, None, result.VerificationResult(True, error_message=sample_check['msg'],
+                                                               message_code=sample_check['code'])
 
         # TODO: Check mimetype to use different approaches for video and image inputs
         # mimetype = sample_check['mimetype']
         image = sample_check['image']
 
-        if utils.is_black_image(image):
-            return result.VerificationResult(True, code=result.VerificationResult.AlertCode.WARNING,
-                                             error_message="Black Image.",
-                                             message_code=message.Provider.PROVIDER_BLACK_IMAGE.value)
+        with self._timer.stage('black_check'):
+            is_black = utils.is_black_image(image)
+        if is_black:
+            return None, None, None, result.VerificationResult(
+                True, code=result.VerificationResult.AlertCode.WARNING, error_message="Black Image.",
+                message_code=message.Provider.PROVIDER_BLACK_IMAGE.value)
 
-        # Detect faces in current image
-        face_locations = face_recognition.face_locations(
-            image,
-            number_of_times_to_upsample=self.config['number_of_times_to_upsample'],
-            model=self.config['model']
-        )
+        warnings = []
+        quality_error = self._check_quality(image)
+        if quality_error is not None:
+            if self.config['quality_gate'] == 'reject':
+                return None, None, None, result.VerificationResult(
+                    True, code=result.VerificationResult.AlertCode.WARNING, error_message=quality_error,
+                    message_code=TFRMessage.PROVIDER_LOW_QUALITY_IMAGE.value)
+            warnings.append(TFRMessage.PROVIDER_LOW_QUALITY_IMAGE.value)
+
+        return image, sample_check['scale'], warnings, None
+
+    def _get_frame_key(self, request):
+        """
+            Get the key used to store the faces of a request image in the frame cache. It is computed from the raw
+            request data, so repeated frames are not decoded.
+            :param request: Verification request
+            :type request: tesla_ce_provider.models.base.Request
+            :return: Frame key or None if the frame cache is disabled or the request has no data
+            :rtype: tuple
+        """
+        if not self._frame_cache.enabled or not isinstance(request.data, str):
+            return None
+        quality = (self.config['quality_gate'], self.config['quality_min_sharpness'],
+                   self.config['quality_min_contrast'], self.config['quality_min_brightness'],
+                   self.config['quality_max_brightness'])
+        return (utils.get_data_hash(request.data), request.mime_type) + self._get_detection_key() + quality + (
+            self._get_verification_num_jitters(), )
+
+    def _put_frame(self, frame_key, frame_data):
+        """
+            Store the faces of a request image in the frame cache
+            :param frame_key: Frame key, or None if the frame cache is disabled
+            :type frame_key: tuple
+            :param frame_data: Scale factor, warnings, face locations and encodings of the image
+            :type frame_data: tuple
+        """
+        # Results obtained with degraded settings are not cached
+        if frame_key is not None and len(self._degraded_stages) == 0:
+            self._frame_cache.put(frame_key, frame_data)
+
+    def _get_frame_image(self, request, image):
+        """
+            Get the image of a request, decoding it if the faces were taken from the frame cache
+            :param request: Verification request
+            :type request: tesla_ce_provider.models.base.Request
+            :param image: Image, or None if it was not decoded
+            :type image: np.array
+            :return: Image
+            :rtype: np.array
+        """
+        if image is not None:
+            return image
+        with self._timer.stage('decode'):
+            return utils.decode_sample_image(request, self.config['max_working_resolution'])[0]
+
+    def _get_verification_num_jitters(self):
+        """
+            Get the number of jitters used to encode the faces found in verification requests
+            :return: Number of jitters
+            :rtype: int
+        """
+        if self.config['verification_jitter_policy'] == 'adaptive':
+            return 1
+        return self.config['encoding_num_jitters']
+
+    def _is_uncertain_score(self, score):
+        """
+            Check if a verification score is close to the alert or warning thresholds
+            :param score: Verification score
+            :type score: float
+            :return: True if the score is inside the uncertainty band of any threshold
+            :rtype: bool
+        """
+        info = self.info or {}
+        thresholds = [info.get('alert_below', self.DEFAULT_ALERT_BELOW),
+                      info.get('warning_below', self.DEFAULT_WARNING_BELOW)]
+        for threshold in thresholds:
+            if abs(score - threshold) < self.config['adaptive_jitter_band']:
+                return True
+        return False
+
+    def _needs_audit_images(self, score, num_faces, warnings):
+        """
+            Check if the images of the faces must be added to the audit of a verification result
+            :param score: Verification score
+            :type score: float
+            :param num_faces: Number of faces found in the image
+            :type num_faces: int
+            :param warnings: Warnings added to the audit
+            :type warnings: list
+            :return: True if face images must be added to the audit
+            :rtype: bool
+        """
+        if self.config['audit_images'] == 'never':
+            return False
+        if self.config['audit_images'] == 'alerts':
+            # Only results that will be reviewed (alerts, warnings or low scores) need the images
+            info = self.info or {}
+            return num_faces > 1 or len(warnings) > 0 or score < info.get('warning_below',
+                                                                          self.DEFAULT_WARNING_BELOW)
+        return True
+
+    def _get_request_deadline(self, request):
+        """
+            Get the deadline of a verification request. It is taken from the 'deadline' value in request metadata, as
+            a UNIX timestamp. Otherwise, if a default verification deadline is configured, it is counted from the
+            'timestamp' value in request metadata, or from now if it is not available.
+            :param request: Verification request
+            :type request: tesla_ce_provider.models.base.Request
+            :return: Deadline as a UNIX timestamp, or None if the request has no deadline
+            :rtype: float
+        """
+        metadata = request.metadata or {}
+        if isinstance(metadata.get('deadline'), (int, float)):
+            return float(metadata['deadline'])
+        if self.config['verification_deadline'] > 0:
+            start = metadata.get('timestamp')
+            if not isinstance(start, (int, float)):
+                start = time.time()
+            return float(start) + self.config['verification_deadline']
+        return None
+
+    def _start_deadline(self, requests=None):
+        """
+            Set the deadline for the verification of a list of requests, which is the earliest deadline of the
+            requests
+            :param requests: Verification requests. If not provided, the deadline is removed
+            :type requests: list
+        """
+        self._deadline = None
+        self._degraded_stages = []
+        deadlines = [self._get_request_deadline(request) for request in requests or []]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        if len(deadlines) > 0:
+            self._deadline = min(deadlines)
+
+    def _is_degraded(self, stage):
+        """
+            Check if a stage of current request must use cheaper settings, because the remaining time until the
+            deadline is below the configured margin. Degraded stages are recorded in the result.
+            :param stage: Stage name
+            :type stage: str
+            :return: True if the stage must be degraded
+            :rtype: bool
+        """
+        if stage in self._degraded_stages:
+            return True
+        if self._deadline is None or self._deadline - time.time() >= self.config['deadline_margin']:
+            return False
+        self.log_trace('TFR: Deadline is close. Using degraded {} stage: [remaining={:.2f}s]'.format(
+            stage, self._deadline - time.time()))
+        self._degraded_stages.append(stage)
+        return True
+
+    def _find_faces_degraded(self, image):
+        """
+            Find the faces in an image using the hog detector without upsampling, which is the cheapest setting
+            :param image: Image
+            :type image: np.array
+            :return: List of face locations as (top, right, bottom, left)
+            :rtype: list
+        """
+        detection_image, scale = self._get_detection_image(image)
+        face_locations = face_recognition.face_locations(detection_image, number_of_times_to_upsample=0, model='hog')
+        if scale == 1.0:
+            return face_locations
+        return [utils.scale_face_location(location, scale, image.shape) for location in face_locations]
+
+    def _encode_faces(self, image, face_locations):
+        """
+            Compute the encodings for the faces found in an image
+            :param image: Image
+            :type image: np.array
+            :param face_locations: List of face locations
+            :type face_locations: list
+            :return: Face locations and encodings
+            :rtype: tuple
+        """
+        encodings = []
+        num_jitters = self._get_verification_num_jitters()
+        if len(face_locations) > 0:
+            if num_jitters > 1 and self._is_degraded('encoding'):
+                num_jitters = 1
+            with self._timer.stage('encoding'):
+                encodings = face_recognition.face_encodings(image,
+                                                            face_locations,
+                                                            num_jitters=num_jitters)
+        return face_locations, encodings
+
+    def _get_verification_result(self, tfr_model, request, image, scale, warnings, face_locations, encodings):
+        """
+            Compare the faces found in a request with the learner model
+            :param tfr_model: Learner model
+            :type tfr_model: FRSimpleModel
+            :param request: Verification request
+            :type request: tesla_ce_provider.models.base.Request
+            :param image: Image, or None if the faces were taken from the frame cache. It is decoded if needed
+            :type image: np.array
+            :param scale: Scale factor from image to original coordinates, used for the coordinates in the audit
+            :type scale: float
+            :param warnings: Warnings added to the audit
+            :type warnings: list
+            :param face_locations: List of face locations
+            :type face_locations: list
+            :param encodings: List of face encodings
+            :type encodings: list
+            :return: Verification result
+            :rtype: tesla_ce_provider.VerificationResult
+        """
+        audit = FaceRecognitionAudit(warnings=warnings)
+        if len(self._degraded_stages) > 0:
+            audit.warnings.append(TFRMessage.PROVIDER_DEGRADED_PROCESSING.value)
         if len(face_locations) == 0:
             return result.VerificationResult(True, code=result.VerificationResult.AlertCode.WARNING,
                                              error_message="No faces in image.",
-                                             message_code=message.Provider.PROVIDER_NO_FACE_DETECTED.value)
-        # Get sample encodings
-        encodings = face_recognition.face_encodings(image,
-                                                    face_locations,
-                                                    num_jitters=self.config['encoding_num_jitters'])
-        # Get reference encodings
-        reference_encodings = tfr_model.get_encodings()
-
-        # Compute distances between found faces and model
-        distances = []
-        audit = FaceRecognitionAudit()
-
-        for i, face_encoding in enumerate(encodings, 0):
-            distances = list(face_recognition.face_distance(reference_encodings, face_encoding))
-            distance = min(distances)
-            idx = int(np.argmin(distances))
-            audit.add_face(coordinates=face_locations[i],
-                           score=1.0 - distance,
-                           image=utils.get_face_image(image, face_locations[i]),
-                           most_similar=tfr_model.get_sample_id(idx))
-            distances.append(distance)
+                                             message_code=message.Provider.PROVIDER_NO_FACE_DETECTED.value,
+                                             audit=audit if len(audit.warnings) > 0 else None)
+
+        # Compute distances between all the found faces and model at once
+        with self._timer.stage('distance'):
+            indexes, distances = tfr_model.search(encodings, self.config['early_exit_distance'],
+                                                  self.config['search_block_size'])
+        face_distances = []
+        most_similar = []
+
+        for i, (idx, distance) in enumerate(zip(indexes, distances)):
+            idx = int(idx)
+            distance = float(distance)
+            if self.config['verification_jitter_policy'] == 'adaptive' and self._is_uncertain_score(1.0 - distance) \
+                    and not self._is_degraded('encoding'):
+                # Ambiguous faces are encoded again with the full number of jitters
+                self.log_trace('TFR: Uncertain score. Compute encodings with {} jitters.'.format(
+                    self.config['encoding_num_jitters']))
+                image = self._get_frame_image(request, image)
+                with self._timer.stage('encoding'):
+                    face_encoding = face_recognition.face_encodings(
+                        image, [face_locations[i]], num_jitters=self.config['encoding_num_jitters'])[0]
+                with self._timer.stage('distance'):
+                    retry_indexes, retry_distances = tfr_model.search([face_encoding],
+                                                                      self.config['early_exit_distance'],
+                                                                      self.config['search_block_size'])
+                    idx = int(retry_indexes[0])
+                    distance = float(retry_distances[0])
+            face_distances.append(distance)
+            most_similar.append(tfr_model.get_sample_id(idx))
 
         # Get the minimum distance and convert to the final score
-        score = 1.0 - min(distances)
+        score = 1.0 - min(face_distances)
+
+        # Add the faces to the audit, with their images if required by the audit policy
+        add_images = self._needs_audit_images(score, len(face_locations), audit.warnings) and \
+            not self._is_degraded('audit_image')
+        if len(self._degraded_stages) > 0 and TFRMessage.PROVIDER_DEGRADED_PROCESSING.value not in audit.warnings:
+            audit.warnings.append(TFRMessage.PROVIDER_DEGRADED_PROCESSING.value)
+        face_info = None
+        if len(self._degraded_stages) > 0:
+            face_info = {'degraded': list(self._degraded_stages)}
+        for location, distance, sample_id in zip(face_locations, face_distances, most_similar):
+            face_image = None
+            if add_images:
+                image = self._get_frame_image(request, image)
+                with self._timer.stage('audit_image'):
+                    face_image = utils.get_face_image(image, location,
+                                                      quality=self.config['audit_image_quality'],
+                                                      max_side=self.config['audit_image_max_side'])
+            audit.add_face(coordinates=utils.scale_face_location(location, scale),
+                           score=1.0 - distance,
+                           image=face_image,
+                           most_similar=sample_id,
+                           info=face_info)
 
         # Check alerts
         if len(face_locations) > 1:
@@ -271,6 +1101,107 @@ class TFRProvider(BaseProvider):
         return result.VerificationResult(True, result=score,
                                          code=result.VerificationResult.AlertCode.OK, audit=audit)
 
+    @instrumented('verify')
+    def verify(self, request, model):
+        """
+            Verify a learner request
+            :param request: Verification request
+            :type request: tesla_ce_provider.models.base.Request
+            :param model: Provider model
+            :type model: dict
+            :return: Verification result
+            :rtype: tesla_ce_provider.VerificationResult
+        """
+        self._start_deadline([request])
+
+        # Load model
+        with self._timer.stage('model'):
+            tfr_model = self._load_model(request.learner_id, model)
+
+        # Identical frames are taken from cache, without decoding them
+        frame_data = None
+        with self._timer.stage('frame_cache'):
+            frame_key = self._get_frame_key(request)
+            if frame_key is not None:
+                frame_data = self._frame_cache.get(frame_key)
+        if frame_data is not None:
+            self.log_trace('TFR: Using cached detection for repeated frame.')
+            return self._get_verification_result(tfr_model, request, None, *frame_data)
+
+        # Get the image
+        image, scale, warnings, error_result = self._get_verification_image(request)
+        if error_result is not None:
+            return error_result
+
+        # Detect faces in current image and compute their encodings
+        with self._timer.stage('detection'):
+            if self._is_degraded('detection'):
+                face_locations = self._find_faces_degraded(image)
+            elif self.config['roi_tracking'] and request.session_id is not None:
+                face_locations = self._find_session_faces(image, (request.learner_id, request.session_id))
+            else:
+                face_locations = self._find_faces(image)
+        frame_data = (scale, warnings) + self._encode_faces(image, face_locations)
+        self._put_frame(frame_key, frame_data)
+
+        return self._get_verification_result(tfr_model, request, image, *frame_data)
+
+    @instrumented('verify_batch')
+    def verify_batch(self, requests, models):
+        """
+            Verify a list of learner requests, detecting the faces of all the images together
+            :param requests: Verification requests
+            :type requests: list
+            :param models: Provider model for each request
+            :type models: list
+            :return: Verification result for each request, in the same order
+            :rtype: list
+        """
+        # All the requests of the batch are processed before the earliest deadline
+        self._start_deadline(requests)
+        results = [None] * len(requests)
+        tfr_models = [None] * len(requests)
+        frames = [None] * len(requests)
+        pending = []
+        for idx, (request, model) in enumerate(zip(requests, models)):
+            with self._timer.stage('model'):
+                tfr_models[idx] = self._load_model(request.learner_id, model)
+            frame_key = self._get_frame_key(request)
+            if frame_key is not None:
+                frame_data = self._frame_cache.get(frame_key)
+                if frame_data is not None:
+                    frames[idx] = (None, frame_key, frame_data, [])
+                    continue
+            image, scale, warnings, error_result = self._get_verification_image(request)
+            if error_result is not None:
+                results[idx] = error_result
+                continue
+            frames[idx] = (image, frame_key, (scale, warnings), [])
+            pending.append(idx)
+
+        # Detect faces in all the pending images
+        self.log_trace('TFR: Detecting faces for {} of {} requests.'.format(len(pending), len(requests)))
+        with self._timer.stage('detection'):
+            images = [frames[idx][0] for idx in pending]
+            if len(pending) > 0 and self._is_degraded('detection'):
+                batch_locations = [self._find_faces_degraded(image) for image in images]
+            else:
+                batch_locations = self._find_faces_batch(images)
+        for idx, face_locations in zip(pending, batch_locations):
+            image, frame_key, frame_info, _ = frames[idx]
+            frame_data = frame_info + self._encode_faces(image, face_locations)
+            self._put_frame(frame_key, frame_data)
+            frames[idx] = (image, frame_key, frame_data, list(self._degraded_stages))
+
+        for idx, frame in enumerate(frames):
+            if frame is not None:
+                image, _, frame_data, degraded_stages = frame
+                # Each result reports the stages degraded while its request was processed
+                self._degraded_stages = degraded_stages
+                results[idx] = self._get_verification_result(tfr_models[idx], requests[idx], image, *frame_data)
+
+        return results
+
     def on_notification(self, key, info):
         """
             Respond to a notification task
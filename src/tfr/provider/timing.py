@@ -0,0 +1,167 @@
+#  Copyright (c) 2020 Xavier Baró
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Face Recognition timing instrumentation module """
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+
+class _StageContext:
+    """
+        Context manager measuring the duration of a stage
+    """
+    __slots__ = ('_timer', '_name', '_start')
+
+    def __init__(self, timer, name):
+        self._timer = timer
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._timer.add(self._name, time.monotonic() - self._start)
+        return False
+
+
+class _NullStageContext:
+    """
+        Context manager that does nothing
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStageContext()
+
+
+class StageTimer:
+    """
+        Collect the time spent in each stage of a provider operation
+    """
+    enabled = True
+
+    def __init__(self, operation):
+        """
+            Create a timer for an operation
+            :param operation: Operation name
+            :type operation: str
+        """
+        #: Operation name
+        self.operation = operation
+
+        #: Accumulated time for each stage, in seconds
+        self.timings = OrderedDict()
+
+        self._start = time.monotonic()
+
+        # Stages can be measured from several threads, as in parallel enrolment
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """
+            Measure a stage. Time of stages with the same name is accumulated.
+            :param name: Stage name
+            :type name: str
+            :return: Context manager measuring the stage
+        """
+        return _StageContext(self, name)
+
+    def add(self, name, duration):
+        """
+            Add time to a stage
+            :param name: Stage name
+            :type name: str
+            :param duration: Duration in seconds
+            :type duration: float
+        """
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + duration
+
+    def get_timings(self):
+        """
+            Get the time of each stage and the total time of the operation, in milliseconds
+            :return: Stage timings
+            :rtype: dict
+        """
+        timings = OrderedDict((name, duration * 1000.0) for name, duration in self.timings.items())
+        timings['total'] = (time.monotonic() - self._start) * 1000.0
+        return timings
+
+
+class NullTimer:
+    """
+        Timer used when instrumentation is disabled. Stages are not measured.
+    """
+    enabled = False
+    operation = None
+
+    def stage(self, name):
+        """
+            Measure a stage
+            :param name: Stage name
+            :type name: str
+            :return: Context manager that does nothing
+        """
+        return _NULL_STAGE
+
+    def add(self, name, duration):
+        """
+            Add time to a stage
+            :param name: Stage name
+            :type name: str
+            :param duration: Duration in seconds
+            :type duration: float
+        """
+
+    def get_timings(self):
+        """
+            Get the time of each stage
+            :return: Empty timings
+            :rtype: dict
+        """
+        return {}
+
+
+#: Shared instance for disabled instrumentation
+NULL_TIMER = NullTimer()
+
+
+def instrumented(operation):
+    """
+        Decorator for provider methods whose stages are measured when instrumentation is enabled
+        :param operation: Operation name
+        :type operation: str
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(provider, *args, **kwargs):
+            if not provider.config.get('instrumentation', False):
+                return method(provider, *args, **kwargs)
+            provider.start_timer(operation)
+            try:
+                return method(provider, *args, **kwargs)
+            finally:
+                provider.finish_timer()
+        return wrapper
+    return decorator
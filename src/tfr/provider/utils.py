@@ -14,66 +14,284 @@
 #      along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ TeSLA CE Face Recognition utility module """
 import base64
+import hashlib
+import importlib.util
+import os
+import sys
+import threading
 from base64 import binascii
 from io import BytesIO
 import numpy as np
 from PIL import Image, UnidentifiedImageError
 from tesla_ce_provider import message
 
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
 
-def get_sample_image(sample):
+#: Environment variables limiting the threads of BLAS and OpenMP libraries when they are loaded
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS')
+
+#: Number of image rows copied at once when converting images to arrays
+IMAGE_BLOCK_ROWS = 32
+
+
+def lazy_import(name):
+    """
+        Import a module, delaying its execution until one of its attributes is accessed. The first access is not
+        thread-safe before Python 3.12, so modules used from several threads must be loaded first with
+        load_lazy_module.
+
+        :param name: Module name
+        :type name: str
+        :return: Module
+        :rtype: module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError("No module named '{}'".format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load_lazy_module(module):
+    """
+        Execute a module imported with lazy_import, if it was not executed yet
+
+        :param module: Module
+        :type module: module
+        :return: Loaded module
+        :rtype: module
+    """
+    # Accessing any attribute executes the module
+    getattr(module, '__file__', None)
+    return module
+
+
+class ModelPool:
+    """
+        Wrapper of a dlib model that can be used from several threads. dlib detectors and networks keep intermediate
+        results in the model object, so each concurrent call uses a different instance. Instances are created when
+        needed and kept for later calls.
+    """
+    def __init__(self, model, factory):
+        """
+            :param model: Model instance
+            :param factory: Function creating a new instance of the model
+            :type factory: callable
+        """
+        self._factory = factory
+        self._free = [model]
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """
+            Number of instances of the model that are not in use
+            :return: Number of instances
+            :rtype: int
+        """
+        return len(self._free)
+
+    def _run(self, method, *args, **kwargs):
+        with self._lock:
+            model = self._free.pop() if len(self._free) > 0 else None
+        if model is None:
+            model = self._factory()
+        try:
+            if method is None:
+                return model(*args, **kwargs)
+            return getattr(model, method)(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._free.append(model)
+
+    def __call__(self, *args, **kwargs):
+        return self._run(None, *args, **kwargs)
+
+    def __getattr__(self, name):
+        def run_method(*args, **kwargs):
+            return self._run(name, *args, **kwargs)
+        return run_method
+
+
+def set_thread_safe_models(module):
+    """
+        Replace the face detectors and the face encoder of face_recognition with model pools, so its functions can be
+        called from several threads. Shape predictors do not keep state and are shared.
+        :param module: face_recognition module
+        :type module: module
+    """
+    api = load_lazy_module(module).api
+    if isinstance(api.face_encoder, ModelPool):
+        return
+    api.face_detector = ModelPool(api.face_detector, api.dlib.get_frontal_face_detector)
+    api.cnn_face_detector = ModelPool(api.cnn_face_detector,
+                                      lambda: api.dlib.cnn_face_detection_model_v1(api.cnn_face_detection_model))
+    api.face_encoder = ModelPool(api.face_encoder,
+                                 lambda: api.dlib.face_recognition_model_v1(api.face_recognition_model))
+
+
+def set_compute_threads(num_threads):
+    """
+        Limit the number of threads used by numpy BLAS and dlib in current process. Libraries already loaded are
+        limited with threadpoolctl, if available. Environment variables are also set, so libraries loaded later
+        (i.e. dlib, which is loaded on first use) start with the limit.
+
+        :param num_threads: Maximum number of threads
+        :type num_threads: int
+        :return: Effective number of threads for each thread pool
+        :rtype: dict
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(num_threads)
+    if threadpoolctl is not None:
+        threadpoolctl.threadpool_limits(limits=num_threads)
+    return get_compute_threads()
+
+
+def get_compute_threads():
+    """
+        Get the number of threads used by numpy BLAS and dlib in current process
+
+        :return: Number of threads for each loaded thread pool if threadpoolctl is available, or the value of the
+                 thread limit environment variables otherwise
+        :rtype: dict
+    """
+    if threadpoolctl is None:
+        return {name: os.getenv(name) for name in THREAD_ENV_VARS if os.getenv(name) is not None}
+    return {'{}:{}'.format(pool['internal_api'], os.path.basename(pool['filepath'])): pool['num_threads']
+            for pool in threadpoolctl.threadpool_info()}
+
+
+def get_sample_image(sample, max_side=0):
     """
         Get image from sample
 
         :param sample: Sample structure
         :type sample: tesla_ce_provider.models.base.Sample | tesla_provider.models.base.Request
+        :param max_side: If greater than 0, maximum size for the larger side of the image
+        :type max_side: int
         :return: Image
         :rtype: np.Array
     """
+    return decode_sample_image(sample, max_side)[0]
+
+
+def decode_sample_image(sample, max_side=0):
+    """
+        Decode the image from a sample, optionally reducing its resolution. JPEG images are decoded directly at a
+        reduced scale, and other formats are resized after decoding.
+
+        :param sample: Sample structure
+        :type sample: tesla_ce_provider.models.base.Sample | tesla_provider.models.base.Request
+        :param max_side: If greater than 0, maximum size for the larger side of the image
+        :type max_side: int
+        :return: Image and the scale factor from image to original coordinates. Image is None if it cannot be decoded
+        :rtype: tuple
+    """
     try:
-        data = sample.data.split(',')[1]
-    except AttributeError:
-        return None
-    except IndexError:
         data = sample.data
+        start = data.rfind(',') + 1
+    except AttributeError:
+        return None, None
     try:
-        buffer = BytesIO()
-        buffer.write(base64.b64decode(data))
-        buffer.flush()
+        # Base64 text is decoded from the string, which is only sliced if it has a data URI header
+        buffer = BytesIO(binascii.a2b_base64(data[start:] if start > 0 else data))
     except binascii.Error:
-        return None
+        return None, None
     try:
         image = Image.open(buffer)
     except UnidentifiedImageError:
-        return None
+        return None, None
+
+    width = image.width
+    if max_side > 0 and max(image.size) > max_side:
+        # Let the decoder skip resolution (only JPEG supports it), keeping the image larger than requested
+        reduction = float(max(image.size)) / float(max_side)
+        image.draft(None, (int(image.width // reduction), int(image.height // reduction)))
 
-    im_array = np.array(image)
+    im_array = image_to_array(image)
 
-    # Convert from RGBA to RGB
-    if np.shape(im_array)[2] == 4:
-        chanel_r, chanel_g, chanel_b, chanel_a = np.rollaxis(im_array, axis=-1)
-        chanel_r[chanel_a == 0] = 0
-        chanel_g[chanel_a == 0] = 0
-        chanel_b[chanel_a == 0] = 0
-        im_array = np.dstack([chanel_r, chanel_g, chanel_b])
+    if max_side > 0:
+        im_array = resize_image(im_array, max_side)[0]
 
+    return im_array, float(width) / float(im_array.shape[1])
+
+
+def image_to_array(image):
+    """
+        Copy the pixels of an image to a new RGB array, setting transparent pixels to black. Pixels are copied in
+        blocks of rows, so the image is never held twice in memory, as numpy conversion does with the image bytes.
+        :param image: Image
+        :type image: PIL.Image.Image
+        :return: RGB image
+        :rtype: np.array
+    """
+    if image.mode in ('LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    channels = len(image.getbands())
+    im_array = np.empty((image.height, image.width, 3), dtype=np.uint8)
+    for top in range(0, image.height, IMAGE_BLOCK_ROWS):
+        bottom = min(top + IMAGE_BLOCK_ROWS, image.height)
+        block = np.frombuffer(image.crop((0, top, image.width, bottom)).tobytes(), dtype=np.uint8)
+        block = block.reshape((bottom - top, image.width, channels))
+        if channels == 4:
+            block = remove_alpha(block)
+        im_array[top:bottom] = block
     return im_array
 
 
-def check_sample_image(sample, accepted_mimetypes=None):
+def remove_alpha(im_array):
+    """
+        Convert an RGBA image to RGB, setting transparent pixels to black
+        :param im_array: RGBA image
+        :type im_array: np.array
+        :return: RGB image
+        :rtype: np.array
+    """
+    # Channels are copied one by one, which is much faster than copying the strided RGB view at once
+    rgb = np.empty(im_array.shape[:2] + (3,), dtype=np.uint8)
+    opaque = im_array[..., 3] != 0
+    if opaque.all():
+        for channel in range(3):
+            rgb[..., channel] = im_array[..., channel]
+    else:
+        for channel in range(3):
+            np.multiply(im_array[..., channel], opaque, out=rgb[..., channel])
+    return rgb
+
+
+def check_sample_image(sample, accepted_mimetypes=None, max_side=0):
     """
         Check sample information
         :param sample: Sample structure
         :type sample: tesla_ce_provider.models.base.Sample | tesla_provider.models.base.Request
         :param accepted_mimetypes: Accepted mimetype values
         :type accepted_mimetypes: list
-        :return: An object with the image and mimetype or the found errors
+        :param max_side: If greater than 0, maximum size for the larger side of the image
+        :type max_side: int
+        :return: An object with the image, the scale factor from image to original coordinates and mimetype or the
+                 found errors
         :rtype: dict
     """
     # Check mimetype
     mimetype = None
     try:
-        sample_mimetype = sample.data.split(',')[0].split(';')[0].split(':')[1]
+        # Only the header is split, as the sample data can be large
+        header_end = sample.data.find(',')
+        header = sample.data[:header_end] if header_end >= 0 else sample.data
+        sample_mimetype = header.split(';')[0].split(':')[1]
         if len(sample_mimetype.strip()) == 0:
             sample_mimetype = None
     except IndexError:
@@ -105,7 +323,7 @@ def check_sample_image(sample, accepted_mimetypes=None):
         }
 
     # Open the image
-    image = get_sample_image(sample)
+    image, scale = decode_sample_image(sample, max_side)
     if image is None:
         return {
             'valid': False,
@@ -117,45 +335,212 @@ def check_sample_image(sample, accepted_mimetypes=None):
     return {
         'valid': True,
         'mimetype': mimetype,
-        'image': image
+        'image': image,
+        'scale': scale
     }
 
 
-def get_face_image(image, face_locations):
+def get_face_image(image, face_locations, quality=75, max_side=0):
     """
-        Cut the face region from an image and returns it as a JPEG image
+        Cut the face region from an image and returns it as a JPEG image. Only the face region is converted to a
+        PIL image.
         :param image: The source image
         :type image: np.array
         :param face_locations: Face location as (top, right, bottom, left)
         :type face_locations: tuple
+        :param quality: JPEG quality (1-95)
+        :type quality: int
+        :param max_side: If greater than 0, maximum size for the larger side of the face image
+        :type max_side: int
         :return: Face image in JPEG format
         :rtype: str
     """
-    # Get the image
-    img = Image.fromarray(image)
-
-    # Crop image
+    # Crop image using a view of the face region
     # (It will not change orginal image)
-    face_img = img.crop((face_locations[3], face_locations[0], face_locations[1], face_locations[2]))
+    top, right, bottom, left = face_locations
+    face_img = Image.fromarray(image[max(top, 0):max(bottom, 0), max(left, 0):max(right, 0)])
+    if max_side > 0 and max(face_img.size) > max_side:
+        face_img.thumbnail((max_side, max_side), Image.BILINEAR)
 
     buffer = BytesIO()
-    face_img.save(buffer, format='jpeg')
+    face_img.save(buffer, format='jpeg', quality=int(quality))
     buffer.flush()
 
     return 'data:image/jpeg;base64,{}'.format(base64.b64encode(buffer.getvalue()).decode('utf-8'))
 
 
-def is_black_image(img):
+def get_luma(img):
+    """
+        Convert an image to grayscale, using the same ITU-R 601-2 transform as PIL
+        :param img: RGB or grayscale image
+        :type img: np.array
+        :return: Grayscale image
+        :rtype: np.array
+    """
+    if img.ndim == 2:
+        return img
+    # Products are computed in 32 bits, as numpy < 2 does not widen an uint8 array multiplied by a scalar
+    luma = np.multiply(img[..., 0], 19595, dtype=np.uint32)
+    channel = np.multiply(img[..., 1], 38470, dtype=np.uint32)
+    luma += channel
+    np.multiply(img[..., 2], 7471, out=channel, dtype=np.uint32)
+    luma += channel
+    luma += 0x8000
+    luma >>= 16
+    return luma
+
+
+def is_black_image(img, step=4, block_rows=64):
     """
-        Check if an image is all black
+        Check if an image is all black. Most images are discarded on the first rows of a subsample of the image, and
+        only dark images are fully analysed.
         :param img: Image to check
         :type img: np.array
+        :param step: Distance between the pixels of the subsample used to discard non black images
+        :type step: int
+        :param block_rows: Number of rows analysed at once
+        :type block_rows: int
         :return: True if the image is black or False otherwise
         :rtype: bool
     """
-    image = Image.fromarray(img)
-    extrema = image.convert("L").getextrema()
-    if extrema[0] == 0 and extrema[1] < 5:
-        return True
+    subsample = img[::step, ::step]
+    for start in range(0, subsample.shape[0], block_rows):
+        if get_luma(subsample[start:start + block_rows]).max() >= 5:
+            return False
+
+    min_luma = 255
+    for start in range(0, img.shape[0], block_rows):
+        luma = get_luma(img[start:start + block_rows])
+        if luma.max() >= 5:
+            return False
+        min_luma = min(min_luma, int(luma.min()))
+    return min_luma == 0
+
+
+def get_image_quality(img, max_side=256):
+    """
+        Compute cheap quality statistics on a downsampled grayscale version of an image
+        :param img: Image
+        :type img: np.array
+        :param max_side: Approximated size of the larger side of the downsampled image
+        :type max_side: int
+        :return: Sharpness as the variance of the Laplacian, contrast as the spread between the 5th and 95th
+                 percentiles of the histogram, and mean brightness
+        :rtype: dict
+    """
+    step = max(1, int(np.ceil(float(max(img.shape[:2])) / float(max_side))))
+    gray = get_luma(img[::step, ::step]).astype(np.float32)
+    if min(gray.shape) < 3:
+        laplacian = np.zeros(1, dtype=np.float32)
+    else:
+        laplacian = 4.0 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1] - gray[1:-1, :-2] - gray[1:-1, 2:]
+    histogram = np.bincount(gray.astype(np.uint8).ravel(), minlength=256)
+    cumulative = np.cumsum(histogram) / float(gray.size)
+    return {
+        'sharpness': float(laplacian.var()),
+        'contrast': float(np.searchsorted(cumulative, 0.95) - np.searchsorted(cumulative, 0.05)),
+        'brightness': float(gray.mean())
+    }
+
+
+def check_image_quality(img, min_sharpness=0, min_contrast=0, min_brightness=0, max_brightness=255):
+    """
+        Check if the quality of an image is enough to look for faces
+        :param img: Image
+        :type img: np.array
+        :param min_sharpness: Minimum variance of the Laplacian
+        :type min_sharpness: float
+        :param min_contrast: Minimum spread between the 5th and 95th percentiles of the histogram
+        :type min_contrast: float
+        :param min_brightness: Minimum mean brightness
+        :type min_brightness: float
+        :param max_brightness: Maximum mean brightness
+        :type max_brightness: float
+        :return: An object with the quality statistics and the found error
+        :rtype: dict
+    """
+    quality = get_image_quality(img)
+    msg = None
+    if quality['brightness'] < min_brightness:
+        msg = "Underexposed image."
+    elif quality['brightness'] > max_brightness:
+        msg = "Overexposed image."
+    elif quality['contrast'] < min_contrast:
+        msg = "Low contrast image."
+    elif quality['sharpness'] < min_sharpness:
+        msg = "Blurred image."
+    return {
+        'valid': msg is None,
+        'msg': msg,
+        'quality': quality
+    }
+
+
+def get_data_hash(data):
+    """
+        Compute a fast hash of the data of a sample, without decoding it
+        :param data: Sample data
+        :type data: str
+        :return: Hash of the data
+        :rtype: str
+    """
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
 
-    return False
+
+def resize_image(img, max_side):
+    """
+        Reduce an image so its larger side is not greater than a given size
+        :param img: Image
+        :type img: np.array
+        :param max_side: Maximum size for the larger side of the image
+        :type max_side: int
+        :return: Resized image and the scale factor from resized to original coordinates
+        :rtype: tuple
+    """
+    height, width = img.shape[:2]
+    scale = float(max(height, width)) / float(max_side)
+    if scale <= 1.0:
+        return img, 1.0
+    new_size = (max(1, int(round(width / scale))), max(1, int(round(height / scale))))
+    resized = np.asarray(Image.fromarray(img).resize(new_size, Image.BILINEAR))
+    return resized, float(width) / float(new_size[0])
+
+
+def scale_face_location(face_location, scale, shape=None):
+    """
+        Scale a face location, optionally keeping it inside the image bounds
+        :param face_location: Face location as (top, right, bottom, left)
+        :type face_location: tuple
+        :param scale: Scale factor
+        :type scale: float
+        :param shape: Shape of the target image
+        :type shape: tuple
+        :return: Scaled face location as (top, right, bottom, left)
+        :rtype: tuple
+    """
+    top, right, bottom, left = [int(round(value * scale)) for value in face_location]
+    if shape is not None:
+        top = max(top, 0)
+        left = max(left, 0)
+        bottom = min(bottom, shape[0])
+        right = min(right, shape[1])
+    return top, right, bottom, left
+
+
+def expand_face_location(face_location, margin, shape):
+    """
+        Expand a face location by a margin relative to the face size, keeping it inside the image bounds
+        :param face_location: Face location as (top, right, bottom, left)
+        :type face_location: tuple
+        :param margin: Margin added to each side, as a fraction of the face size
+        :type margin: float
+        :param shape: Shape of the image
+        :type shape: tuple
+        :return: Expanded region as (top, right, bottom, left)
+        :rtype: tuple
+    """
+    top, right, bottom, left = face_location
+    margin_v = int((bottom - top) * margin)
+    margin_h = int((right - left) * margin)
+    return max(top - margin_v, 0), min(right + margin_h, shape[1]), min(bottom + margin_v, shape[0]), \
+        max(left - margin_h, 0)
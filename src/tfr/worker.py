@@ -0,0 +1,99 @@
+#  Copyright (c) 2020 Xavier Baró
+#
+#      This program is free software: you can redistribute it and/or modify
+#      it under the terms of the GNU Affero General Public License as
+#      published by the Free Software Foundation, either version 3 of the
+#      License, or (at your option) any later version.
+#
+#      This program is distributed in the hope that it will be useful,
+#      but WITHOUT ANY WARRANTY; without even the implied warranty of
+#      MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#      GNU Affero General Public License for more details.
+#
+#      You should have received a copy of the GNU Affero General Public License
+#      along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" TeSLA CE Face Recognition worker module
+
+    Celery signal handlers for the provider workers. Load them when starting the worker:
+
+        celery -A tesla_ce_provider worker --include tfr.worker
+
+    Face models are loaded in the main process before forking the pool processes, so all of them share the same
+    memory pages. Preload can be disabled setting TFR_PRELOAD=0. Each worker process is warmed up with the provider
+    options configured in TeSLA CE, which are the ones used by the tasks. Warm-up can be disabled setting
+    TFR_WARM_UP=0.
+"""
+import gc
+import os
+from celery.signals import worker_init, worker_process_init
+from .provider import TFRProvider, utils
+from .provider.tfr import face_recognition
+
+
+def is_enabled(name, default='1'):
+    """
+        Check if a feature is enabled in an environment variable
+        :param name: Environment variable name
+        :type name: str
+        :param default: Value used if the variable is not defined
+        :type default: str
+        :return: True if enabled or False otherwise
+        :rtype: bool
+    """
+    return os.getenv(name, default) in ['1', 1, 'True', 'yes', 'true']
+
+
+def preload():
+    """
+        Load the face recognition modules and the dlib face detection and encoding models in current process. Call
+        it in the parent process before forking, so the children share the read-only pages of the models instead of
+        loading their own copy. Providers are not created, as their options are only known when running the tasks.
+    """
+    utils.load_lazy_module(face_recognition)
+    # Objects created until now are not tracked by the garbage collector, avoiding writes to shared pages
+    gc.freeze()
+
+
+def get_provider_options():
+    """
+        Get the provider options configured in TeSLA CE, which are set to the provider before running each task
+        :return: Provider options, or None if they are not available
+        :rtype: dict
+    """
+    from tesla_ce_provider.celery_app import client
+    if client is None:
+        return None
+    try:
+        provider_info = client.provider.get(client._connector.get_provider_id())
+    except Exception:
+        # Warm-up must not prevent the worker from starting
+        return None
+    if provider_info is None:
+        return None
+    return provider_info.get('options')
+
+
+@worker_init.connect
+def preload_worker(**kwargs):
+    """
+        Load the face models in the main worker process, before starting the pool
+    """
+    if is_enabled('TFR_PRELOAD'):
+        preload()
+
+
+@worker_process_init.connect
+def warm_up_worker_process(**kwargs):
+    """
+        Warm up the face detection and encoding models in a new worker process, with the same options used by the
+        tasks. If the options are not available, warm-up is skipped, as the default detection model may not be the
+        one used by the tasks.
+    """
+    if not is_enabled('TFR_WARM_UP'):
+        return
+    options = get_provider_options()
+    if options is None:
+        return
+    provider = TFRProvider()
+    provider.set_options(options)
+    provider.warm_up()